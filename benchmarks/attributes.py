@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+Times GsxElement attribute access on the warranty fixture:
+first reads (conversion) and repeated reads (memoized values).
+
+    python benchmarks/attributes.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gsxws.objectify import parse
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..',
+                       'tests', 'fixtures', 'warranty_status.xml')
+
+FIELDS = ('warrantyStatus', 'estimatedPurchaseDate', 'limitedWarranty',
+          'partCovered', 'configDescription', 'coverageEndDate',)
+
+
+def first_read():
+    data = parse(FIXTURE, 'warrantyDetailInfo')
+    for f in FIELDS:
+        getattr(data, f)
+
+
+def repeated_read(data=parse(FIXTURE, 'warrantyDetailInfo')):
+    for f in FIELDS:
+        getattr(data, f)
+
+
+def main(number=10000, repeat=5):
+    parsing = min(timeit.repeat(lambda: parse(FIXTURE, 'warrantyDetailInfo'),
+                                number=number / 10, repeat=repeat)) / (number / 10)
+
+    for func in (first_read, repeated_read,):
+        n = number / 10 if func is first_read else number
+        best = min(timeit.repeat(func, number=n, repeat=repeat)) / n
+
+        if func is first_read:
+            best -= parsing
+
+        print "%-15s %6.2f us per attribute" % (func.__name__,
+                                                best / len(FIELDS) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
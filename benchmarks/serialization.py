@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Times building the SOAP message of a large repair:
+the streaming serializer versus ElementTree.
+
+    python benchmarks/serialization.py
+"""
+import os
+import sys
+import timeit
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xml.etree.ElementTree as ET
+
+from gsxws import serializer
+from gsxws.repairs import CarryInRepair, Customer, RepairOrderLine
+
+
+def make_repair(lines=200):
+    repair = CarryInRepair(serialNumber='DGKFL06JDHJP',
+                           unitReceivedDate=date(2013, 8, 12),
+                           notes=u'Ääkköset & <tags>' * 20,
+                           poNumber=12345)
+    repair.customerAddress = Customer(firstName='Sergey', lastName='Brin',
+                                      emailAddress='sergey@example.com')
+    repair.orderLines = []
+
+    for i in range(lines):
+        line = RepairOrderLine(partNumber='661-%04d' % i, comptiaCode='X01',
+                               comptiaModifier='A', abused=False)
+        repair.orderLines.append(line)
+
+    return repair
+
+
+def elementtree(repair):
+    env = ET.Element("soapenv:Envelope")
+    for prefix, uri in serializer.NAMESPACES:
+        env.set("xmlns:" + prefix, uri)
+    ET.SubElement(env, "soapenv:Header")
+    body = ET.SubElement(env, "soapenv:Body")
+    root = ET.SubElement(body, "emea:CreateCarryIn")
+    request = ET.SubElement(root, "CreateCarryInRequest")
+    user_session = ET.SubElement(request, "userSession")
+    ET.SubElement(user_session, "userSessionId").text = "SESSION1"
+    request.append(repair.to_xml("repairData"))
+    return ET.tostring(env, "UTF-8")
+
+
+def streaming(repair):
+    return "".join(serializer.write_message([], repair, "CreateCarryIn",
+                                            "repairData", "SESSION1"))
+
+
+def main(number=200, repeat=5):
+    repair = make_repair()
+    repair._namespace = "emea:"
+    assert elementtree(repair) == streaming(repair)
+
+    for func in (elementtree, streaming,):
+        best = min(timeit.repeat(lambda: func(repair), number=number,
+                                 repeat=repeat)) / number
+        print "%-12s %8.1f us per message (%d bytes)" % (func.__name__, best * 1e6,
+                                                         len(func(repair)))
+
+
+if __name__ == '__main__':
+    main()
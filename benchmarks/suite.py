@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the hot paths, with results that can be
+compared between releases:
+
+    python benchmarks/suite.py run -o baseline.json
+    ... make changes ...
+    python benchmarks/suite.py run -o results.json
+    python benchmarks/suite.py compare baseline.json results.json
+
+Every benchmark is timed in repeat runs of at least min_time seconds
+and the fastest run is kept, which is the most repeatable number.
+compare exits with 1 if any benchmark got slower than threshold.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import timeit
+import argparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lxml import etree
+
+from gsxws import core, objectify, products, responses
+from gsxws.orders import StockingOrder
+
+from attributes import FIXTURE, FIELDS
+from serialization import make_repair
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures')
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function does the setup
+    and returns the function to time.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup,))
+        return setup
+    return register
+
+
+def make_order(lines=200):
+    order = StockingOrder(purchaseOrderNumber='PO1234', shipToCode='677592')
+    for i in range(lines):
+        order.add_part('661-%04d' % i, i % 5 + 1)
+    return order
+
+
+@benchmark('to_xml.repair')
+def to_xml_repair():
+    repair = make_repair()
+    return lambda: repair.to_xml('repairData')
+
+
+@benchmark('dumps.repair')
+def dumps_repair():
+    return make_repair().dumps
+
+
+@benchmark('dumps.order')
+def dumps_order():
+    return make_order().dumps
+
+
+@benchmark('build.order_lines')
+def build_order_lines():
+    from gsxws.repairs import RepairOrderLine
+    return lambda: [RepairOrderLine(partNumber='661-5571', comptiaCode='X01',
+                                    comptiaModifier='A') for i in range(1000)]
+
+
+def response_tag(path):
+    "The tag of the payload in the response fixture at path"
+    body = etree.parse(path).getroot()[-1]
+    return etree.QName(body[0][0]).localname
+
+
+def parse_fixture(path):
+    response = response_tag(path)
+    with open(path) as fp:
+        xml = fp.read()
+    return lambda: objectify.parse(xml, response)
+
+
+for path in sorted(glob.glob(os.path.join(FIXTURES, '*.xml'))):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if name != 'multierror':
+        benchmark('parse.%s' % name)(lambda path=path: parse_fixture(path))
+
+
+def read_all(path, model, models=True):
+    """
+    Parses path and reads every field of every model._tag element,
+    through the model or objectify
+    """
+    with open(path) as fp:
+        xml = fp.read()
+
+    if not models:
+        tag = model._tag
+        fields = [el.tag for el in etree.fromstring(xml).iter(tag).next()]
+
+        def run():
+            for el in objectify.parse(xml, tag):
+                for f in fields:
+                    getattr(el, f)
+    else:
+        def run():
+            for m in responses.parse(xml, model):
+                for f in model.__slots__:
+                    getattr(m, f)
+    return run
+
+
+for model in set(responses.MODELS.values()):
+    path = os.path.join(FIXTURES, {
+        'warrantyDetailInfo': 'warranty_status.xml',
+        'parts': 'parts_lookup.xml',
+        'lookupResponseData': 'repair_details_ca.xml',
+        'activationDetailsInfo': 'ios_activation.xml',
+        'repairConfirmation': 'repair_confirmation.xml',
+        'orderConfirmation': 'order_confirmation.xml',
+    }[model._tag])
+    benchmark('read_all.objectify.%s' % model._tag)(
+        lambda path=path, model=model: read_all(path, model, False))
+    benchmark('read_all.model.%s' % model._tag)(
+        lambda path=path, model=model: read_all(path, model))
+
+
+@benchmark('attributes.first_read')
+def first_read():
+    with open(FIXTURE) as fp:
+        xml = fp.read()
+
+    def run():
+        data = objectify.parse(xml, 'warrantyDetailInfo')
+        for f in FIELDS:
+            getattr(data, f)
+    return run
+
+
+@benchmark('attributes.repeated_read')
+def repeated_read():
+    data = objectify.parse(FIXTURE, 'warrantyDetailInfo')
+
+    def run():
+        for f in FIELDS:
+            getattr(data, f)
+    return run
+
+
+@benchmark('validate')
+def validate():
+    values = ['DGKFL06JDHJP', '013348005376007', '661-5097', '123456789012',
+              'MacBook Pro (15-inch, Mid 2012)', 'G123456789', 'blaa']
+    return lambda: [core.validate(v) for v in values]
+
+
+@benchmark('GsxError.multierror')
+def gsx_error():
+    with open(os.path.join(FIXTURES, 'multierror.xml')) as fp:
+        xml = fp.read()
+    return lambda: core.GsxError(xml=xml)
+
+
+@benchmark('products.models')
+def models():
+    return products.models
+
+
+@benchmark('catalog.search')
+def catalog_search():
+    from gsxws.catalog import CATALOG
+    return lambda: CATALOG.search('macbook pro (13', limit=10)
+
+
+def measure(func, repeat=5, min_time=0.2):
+    "Returns (best, median) seconds per call of func"
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 10 else 1 + int(min_time / elapsed)
+
+    runs = sorted(timeit.repeat(func, number=number, repeat=repeat))
+    return runs[0] / number, runs[len(runs) // 2] / number, number
+
+
+def run(names=None, repeat=5, min_time=0.2):
+    results = {}
+
+    for name, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+
+        best, median, number = measure(setup(), repeat, min_time)
+        results[name] = {'best': best, 'median': median, 'number': number}
+        print "%-40s %12.2f us" % (name, best * 1e6)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(baseline, results, threshold=0.1):
+    "Prints the changes and returns the names of the regressed benchmarks"
+    regressions = []
+
+    for name in sorted(results['results']):
+        new = results['results'][name]['best']
+        try:
+            old = baseline['results'][name]['best']
+        except KeyError:
+            print "%-40s %12s" % (name, 'new')
+            continue
+
+        change = new / old - 1
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+
+        print "%-40s %10.2f us %+7.1f%% %s" % (name, new * 1e6, change * 100, flag)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='gsxws benchmarks')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('run', help='run the benchmarks')
+    p.add_argument('names', nargs='*', help='only run benchmarks containing these')
+    p.add_argument('-o', '--output', help='write the results to this JSON file')
+    p.add_argument('-r', '--repeat', type=int, default=5)
+    p.add_argument('-t', '--min-time', type=float, default=0.2,
+                   help='seconds each repeat should last')
+
+    p = commands.add_parser('compare', help='compare results with a baseline')
+    p.add_argument('baseline')
+    p.add_argument('results')
+    p.add_argument('-t', '--threshold', type=float, default=0.1,
+                   help='slowdown that counts as a regression (0.1 = 10%%)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(args.names, args.repeat, args.min_time)
+        if args.output:
+            with open(args.output, 'w') as fp:
+                json.dump(results, fp, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    with open(args.results) as fp:
+        results = json.load(fp)
+
+    regressions = compare(baseline, results, args.threshold)
+
+    if regressions:
+        print "%d regression(s): %s" % (len(regressions), ", ".join(regressions))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
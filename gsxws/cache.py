@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+"gsxws/cache.py"
+import os
+import json
+import stat
+import time
+import errno
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from datetime import timedelta
+from collections import OrderedDict
+
+# Read-only operations whose responses can be cached,
+# with the number of seconds to keep them
+CACHE_TTL = {
+    'WarrantyStatus': 60 * 60,
+    'FetchProductModel': 24 * 60 * 60,
+    'PartsLookup': 60 * 60,
+    'RepairDetails': 60,
+    'FetchIOSActivationDetails': 60 * 60,
+}
+
+
+def private_dir(name="gsxws"):
+    """
+    Returns the directory under the system temp dir where this user's
+    caches are kept, creating it if needed. It's only readable by the
+    user, since the caches are pickled and loading them runs code.
+    Raises EnvironmentError if the directory belongs to someone else
+    or others can write to it.
+    """
+    path = os.path.join(tempfile.gettempdir(), name)
+    getuid = getattr(os, 'getuid', None)
+
+    if getuid is None:
+        # Windows, where the temp dir is per-user to begin with
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return path
+
+    path = "%s-%d" % (path, getuid(),)
+
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(path)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != getuid() or st.st_mode & 022:
+        raise EnvironmentError(errno.EPERM, "Unsafe cache directory", path)
+
+    return path
+
+
+def canonical(data):
+    """
+    Returns a stable string representation of a request payload
+
+    >>> canonical({'b': [1, 2], 'a': u'x'}) == canonical({'a': 'x', 'b': [1, 2]})
+    True
+    """
+    def default(obj):
+        if hasattr(obj, '_data'):
+            return obj._data
+        return repr(obj)
+
+    return json.dumps(data, sort_keys=True, default=default)
+
+
+class MemoryCache(object):
+    """
+    Thread-safe in-memory store that evicts the least
+    recently used entry once it holds maxsize entries.
+
+    >>> MemoryCache().set('spam', 'eggs', 10).get('spam')
+    'eggs'
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                return None
+
+            self._data[key] = (value, expires,)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + ttl,)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return self
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache(object):
+    """
+    Caches raw responses of the operations listed in ttl.
+    The backend can be anything with the get(key) and
+    set(key, value, ttl) methods of MemoryCache.
+    """
+    def __init__(self, backend=None, ttl=CACHE_TTL):
+        self.backend = MemoryCache() if backend is None else backend
+        self.ttl = dict(ttl)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def cacheable(self, method):
+        return self.ttl.get(method, 0) > 0
+
+    def key(self, method, payload):
+        "The cache key of a call, payload should not include the session"
+        digest = hashlib.sha1(canonical(payload)).hexdigest()
+        return "%s:%s" % (method, digest,)
+
+    def get(self, key):
+        value = self.backend.get(key)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, key, value, method):
+        self.backend.set(key, value, self.ttl[method])
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': float(self.hits) / total if total else 0.0,
+        }
+
+
+class GsxCache(object):
+    """
+    Expiring key/value store that can be shared between threads
+    and processes. Entries are kept in a SQLite database in WAL mode,
+    separated by name. Once a cache holds more than maxsize entries,
+    the ones closest to expiring are evicted. Values are pickled, so
+    the database must not be writable by anyone else; by default it's
+    kept in private_dir().
+
+    >>> with GsxCache('test') as cache:
+    ...     cache.set('spam', 'eggs').get('spam')
+    'eggs'
+    """
+    tmpdir = None   # private_dir() if not set
+
+    def __init__(self, name, expires=timedelta(minutes=20), maxsize=1000,
+                 filename=None):
+        self.name = name
+        self.expires = expires
+        self.maxsize = maxsize
+        self.filename = filename or os.path.join(self.tmpdir or private_dir(),
+                                                 "gsxws_cache.db")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        self._db.execute("""CREATE TABLE IF NOT EXISTS cache (
+            name TEXT, key TEXT, value BLOB, expires REAL,
+            PRIMARY KEY (name, key))""")
+
+    @property
+    def _db(self):
+        "The connection of the current thread (and process)"
+        db = getattr(self._local, 'db', None)
+
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.filename, timeout=30, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+            with self._lock:
+                self._connections.append((os.getpid(), db,))
+
+        return db
+
+    def _ttl(self, expires):
+        expires = self.expires if expires is None else expires
+        if isinstance(expires, timedelta):
+            return expires.total_seconds()
+        return expires
+
+    def get(self, key):
+        row = self._db.execute("SELECT value, expires FROM cache "
+                               "WHERE name = ? AND key = ?",
+                               (self.name, key,)).fetchone()
+        if row is None:
+            return None
+
+        if row[1] < time.time():
+            self.delete(key)
+            return None
+
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, value, expires=None):
+        """
+        Stores value under key for expires (a timedelta or seconds),
+        defaulting to the expiry time of this cache
+        """
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        expires = time.time() + self._ttl(expires)
+
+        db = self._db
+        db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                   (self.name, key, value, expires,))
+
+        count = db.execute("SELECT COUNT(*) FROM cache WHERE name = ?",
+                           (self.name,)).fetchone()[0]
+
+        if count > self.maxsize:
+            db.execute("DELETE FROM cache WHERE name = ? AND key IN "
+                       "(SELECT key FROM cache WHERE name = ? "
+                       "ORDER BY expires LIMIT ?)",
+                       (self.name, self.name, count - self.maxsize,))
+
+        return self
+
+    def add(self, key, value, expires=None):
+        """
+        Stores value only if key isn't set (or has expired).
+        Returns True if it was stored, which happens in one
+        process only, so this can be used as a shared lock.
+        """
+        value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        now = time.time()
+
+        db = self._db
+        db.execute("DELETE FROM cache WHERE name = ? AND key = ? AND expires < ?",
+                   (self.name, key, now,))
+        cursor = db.execute("INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?)",
+                            (self.name, key, value, now + self._ttl(expires),))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._db.execute("DELETE FROM cache WHERE name = ? AND key = ?",
+                         (self.name, key,))
+
+    def clear(self):
+        self._db.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+
+    def close(self):
+        "Closes the connections this process has opened in all threads"
+        with self._lock:
+            for pid, db in self._connections:
+                if pid == os.getpid():
+                    db.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM cache WHERE name = ?",
+                                (self.name,)).fetchone()[0]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+gsxws/catalog.py
+
+The product lines and models of products.yaml. The YAML is parsed
+once and kept as a pickled snapshot next to the other gsxws caches
+(in cache.private_dir()), which is rebuilt only when the YAML file
+changes.
+
+    >>> CATALOG.product_line('iMac (27-inch, Mid 2011)')
+    'IMAC'
+    >>> CATALOG.search('macbook pro (13')[0]
+    'MacBook Pro (13-inch, Early 2011)'
+"""
+import os
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from bisect import bisect_left
+
+from cache import private_dir
+
+# Bumped whenever the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+PRODUCTS_YAML = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "products.yaml")
+
+
+def _load_yaml(path):
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, 'rb') as fp:
+        return yaml.load(fp, Loader=loader)
+
+
+class Catalog(object):
+    """
+    Indexed product catalog. Lookups check the mtime of the YAML
+    file and reload it if it has changed since it was read.
+    """
+    tmpdir = None   # cache.private_dir() if not set
+
+    def __init__(self, path=PRODUCTS_YAML, snapshot=None):
+        self.path = path
+        self._snapshot = snapshot
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        """
+        The snapshot file, which must only be writable by this user
+        since loading it runs code. None if there's no safe place for it.
+        """
+        if self._snapshot is None:
+            try:
+                tmpdir = self.tmpdir or private_dir()
+            except EnvironmentError:
+                return None
+            digest = hashlib.sha1(os.path.abspath(self.path)).hexdigest()[:12]
+            self._snapshot = os.path.join(tmpdir, "gsxws_products_%s.pickle" % digest)
+        return self._snapshot
+
+    def _check(self):
+        "Returns the (lines, by_model, keys, names) of the current YAML"
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._state = self._index(self._read(mtime))
+                    self._mtime = mtime
+        return self._state
+
+    def _read(self, mtime):
+        "Returns the lines from the snapshot, rebuilding it if it's stale"
+        snapshot = self.snapshot
+
+        if snapshot is None:
+            return _load_yaml(self.path)
+
+        try:
+            with open(snapshot, 'rb') as fp:
+                data = pickle.load(fp)
+            if (data['version'], data['path'], data['mtime'],) == \
+               (SNAPSHOT_VERSION, os.path.abspath(self.path), mtime,):
+                return data['lines']
+        except Exception:
+            pass
+
+        lines = _load_yaml(self.path)
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'path': os.path.abspath(self.path),
+            'mtime': mtime,
+            'lines': lines,
+        }
+
+        # Write and rename so that other processes never see half a file
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(snapshot))
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(data, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, snapshot)
+        except EnvironmentError:
+            pass
+
+        return lines
+
+    def _index(self, lines):
+        by_model = {}
+        names = []
+
+        for code, line in lines.items():
+            for name in line.get('models') or []:
+                by_model.setdefault(name, code)
+                names.append((name.lower(), name,))
+
+        names.sort()
+        return (lines, by_model,
+                [k for k, name in names], [name for k, name in names],)
+
+    def models(self):
+        "Returns all product lines, as in products.yaml"
+        lines = self._check()[0]
+        return dict((code, dict(line, models=list(line.get('models') or [])),)
+                    for code, line in lines.items())
+
+    def lines(self):
+        "Returns the (code, name) of every product line"
+        lines = self._check()[0]
+        return sorted((code, line['name'],) for code, line in lines.items())
+
+    def line(self, code):
+        "Returns the model names of the product line code"
+        lines = self._check()[0]
+        try:
+            return list(lines[code].get('models') or [])
+        except KeyError:
+            raise ValueError("Unknown product line: %s" % code)
+
+    def product_line(self, name):
+        "Returns the code of the product line of model name, or None"
+        return self._check()[1].get(name)
+
+    def search(self, text, limit=None):
+        """
+        Returns the model names containing text, ignoring case.
+        Names that start with text come first.
+        """
+        lines, by_model, keys, names = self._check()
+        text = text.lower()
+        start = end = bisect_left(keys, text)
+
+        while end < len(keys) and keys[end].startswith(text):
+            end += 1
+
+        result = names[start:end]
+
+        if limit is None or len(result) < limit:
+            result += [names[i] for i, k in enumerate(keys)
+                       if text in k and not start <= i < end]
+
+        return result[:limit]
+
+
+CATALOG = Catalog()
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
 import logging
-from core import GsxObject, GsxCache
+import threading
+from datetime import timedelta
+
+from core import GsxObject, GsxCache, run_async
 
 MODIFIERS = (
     ("A", "Not Applicable"),
@@ -31,18 +36,125 @@ GROUPS = (
 )
 
 
+# Bumped whenever the format of the stored table changes
+STORE_VERSION = 1
+
+# Seconds between fetches of the CompTIA codes from GSX
+REFRESH_INTERVAL = 24 * 60 * 60
+
+# Seconds between checks for a table refreshed by another process
+CHECK_INTERVAL = 60
+
+
+class ComptiaTable(object):
+    """
+    One version of the CompTIA codes with its lookups prebuilt.
+    codes is {group: {code: description}}, fetched the time
+    they were fetched from GSX.
+    """
+    def __init__(self, codes, fetched):
+        self.codes = codes
+        self.fetched = fetched
+        self.groups = dict((g, tuple(sorted(c.items())),) for g, c in codes.items())
+        self.descriptions = {}
+
+        for g in sorted(codes):
+            for k, v in codes[g].items():
+                self.descriptions.setdefault(k, v)
+
+    def age(self):
+        return time.time() - self.fetched
+
+
+class ComptiaStore(object):
+    """
+    Keeps the CompTIA codes in a GsxCache, so all processes share them
+    and GSX is asked at most once per refresh interval. Only the very
+    first fetch blocks, after that readers get the current table right
+    away while a stale one is refreshed in the background.
+    """
+    def __init__(self, refresh=REFRESH_INTERVAL, cache=None):
+        self.refresh = refresh
+        self.key = "table:v%d" % STORE_VERSION
+        self._cache = cache
+        self._table = None
+        self._checked = 0
+        self._refreshing = False    # set under _lock before a refresh is started
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = GsxCache("comptia", expires=timedelta(days=30))
+        return self._cache
+
+    def get(self):
+        "Returns the current ComptiaTable"
+        table = self._table
+
+        if table is not None and table.age() < self.refresh:
+            return table
+
+        with self._lock:
+            if self._table is table and time.time() - self._checked > CHECK_INTERVAL:
+                self._checked = time.time()
+                stored = self.cache.get(self.key)
+                if stored and (table is None or stored['fetched'] > table.fetched):
+                    self._table = ComptiaTable(stored['codes'], stored['fetched'])
+
+            if self._table is None:
+                self._table = self.fetch()
+            elif self._table.age() >= self.refresh and not self._refreshing:
+                self._refreshing = True
+                run_async(self._refresh)
+
+            return self._table
+
+    def fetch(self):
+        "Fetches the codes from GSX and stores them"
+        codes = CompTIA().lookup()
+        fetched = time.time()
+        self.cache.set(self.key, {'codes': codes, 'fetched': fetched})
+        return ComptiaTable(codes, fetched)
+
+    def _refresh(self):
+        lock = self.key + ":refreshing"
+        try:
+            # Only one process refreshes at a time
+            if self.cache.add(lock, os.getpid(), CHECK_INTERVAL * 5):
+                try:
+                    table = self.fetch()
+                finally:
+                    self.cache.delete(lock)
+                with self._lock:
+                    self._table = table
+        except Exception, e:
+            logging.warning("Failed to refresh CompTIA codes: %s" % e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def clear(self):
+        with self._lock:
+            self._table = None
+            self._checked = 0
+            self.cache.delete(self.key)
+
+
+STORE = ComptiaStore()
+
+
 class CompTIA(GsxObject):
     "Stores and accesses CompTIA codes."
     _namespace = "glob:"
 
-    def __init__(self):
+    def __init__(self, store=None):
         """
-        Initialize CompTIA symptoms from the local JSON file
+        The codes come from store, which is shared by default
         """
-        self._comptia = {}
-        self._cache = GsxCache("comptia")
+        self._store = store or STORE
 
-    def fetch(self):
+    def lookup(self):
         """
         Description:
         The CompTIA Codes Lookup API retrieves a list of CompTIA groups and modifiers.
@@ -54,27 +166,32 @@ class CompTIA(GsxObject):
         Users can use the API at any point to retrieve the CompTIA code and modifier details,
         in order to create or update repairs.
 
-        >>> CompTIA().fetch() # doctest: +ELLIPSIS
-        {u'A': {'989': u'Remote Inoperable', ...
+        Always asks GSX, fetch() should be used instead.
         """
-        self._submit("ComptiaCodeLookupRequest", "ComptiaCodeLookup", "comptiaInfo", True)
-
-        if self._cache.get():
-            return self._cache.get()
-
-        root = self._req.objects
+        root = self._submit("ComptiaCodeLookupRequest", "ComptiaCodeLookup",
+                            "comptiaInfo", True)
+        comptia = {}
 
         for el in root.findall(".//comptiaGroup"):
             group = {}
-            comp_id = unicode(el[0].text)
+            comp_id = unicode(el.findtext("componentId"))
 
             for ci in el.findall("comptiaCodeInfo"):
-                group[ci[0].text] = unicode(ci[1].text)
+                code = unicode(ci.findtext("comptiaCode"))
+                group[code] = unicode(ci.findtext("comptiaDescription"))
 
-            self._comptia[comp_id] = group
+            comptia[comp_id] = group
 
-        self._cache.set(self._comptia)
-        return self._comptia
+        return comptia
+
+    def fetch(self):
+        """
+        Returns the CompTIA codes by group
+
+        >>> CompTIA().fetch() # doctest: +ELLIPSIS
+        {u'A': {u'989': u'Remote Inoperable', ...
+        """
+        return self._store.get().codes
 
     def symptoms(self, component=None):
         """
@@ -82,16 +199,20 @@ class CompTIA(GsxObject):
         belonging to the given component code.
 
         >>> CompTIA().symptoms(0) # doctest: +ELLIPSIS
-        {u'B': [(u'B0A', u'Any Camera issue'), ...
+        {u'B': ((u'B0A', u'Any Camera issue'), ...
+        """
+        groups = self._store.get().groups
+        return groups[component] if component else groups
+
+    def describe(self, code):
         """
-        r = dict()
+        Returns the description of a symptom code
 
-        for g, codes in self._comptia.items():
-            r[g] = list()
-            for k, v in codes.items():
-                r[g].append((k, v,))
+        >>> CompTIA().describe('B0A')
+        u'Any Camera issue'
+        """
+        return self._store.get().descriptions.get(code)
 
-        return r[component] if component else r
 
 if __name__ == '__main__':
     import sys
@@ -26,15 +26,19 @@ OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMA
 
 import re
 import json
-import base64
-import shelve
 import os.path
 import hashlib
 import logging
-import httplib
-import tempfile
+import threading
 import objectify
+import serializer
+import instrument
+import responses
 from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+from cache import GsxCache
+from transport import (ConnectionPool, RetryPolicy, CircuitBreakers,
+                       RETRY_STATUSES,)
 import xml.etree.ElementTree as ET
 
 from datetime import date, time, datetime, timedelta
@@ -49,6 +53,26 @@ GSX_TIMEOUT = 30
 
 GSX_SESSION = None
 
+# Sends all requests, a transport.Transport (keep-alive connections by default)
+GSX_TRANSPORT = ConnectionPool()
+
+# Caches the responses of read-only lookups per account when set
+# to a cache.ResponseCache. Off by default, as cached responses
+# can be out of date (see cache.CACHE_TTL)
+GSX_CACHE = None
+
+# How failed calls are retried
+GSX_RETRY = RetryPolicy()
+
+# Calls fail fast while GSX is down, with one breaker per environment/region
+GSX_BREAKERS = CircuitBreakers()
+
+# Return responses.* models instead of GsxElements for the responses that have one
+GSX_MODELS = False
+
+# Number of threads running the *_async calls
+GSX_WORKERS = 32
+
 GSX_REGIONS = (
     ('002', "Asia/Pacific"),
     ('003', "Japan"),
@@ -98,6 +122,26 @@ ENVIRONMENTS = (
 GSX_HOSTS = {'pr': 'ws2', 'it': 'wsit', 'ut': 'wsut'}
 GSX_URL = "https://gsx{env}.apple.com/gsx-ws/services/{region}/asp"
 
+# Fault codes telling us to log in again
+SESSION_EXPIRED_CODES = ('ATH.LOG.20',)
+
+
+# Identifier patterns, in order of precedence
+IDENTIFIERS = (
+    ('eeeCode',             r'[A-Z0-9]{3,4}$'),
+    ('productName',         r'i?Mac'),
+    ('diagnosticEventNumber', r'\d{23}$'),
+    ('repairNumber',        r'\d{12}$'),
+    ('serialNumber',        r'[A-Z0-9]{11,12}$'),
+    ('partNumber',          r'([A-Z]{1,2})?\d{3}\-?(\d{4}|[A-Z]{1,2})(/[A-Z])?$'),
+    ('alternateDeviceId',   r'\d{15}$'),
+    ('returnOrder',         r'7\d{9}$'),
+    ('dispatchId',          r'G\d{9}$'),
+)
+
+_patterns = dict((k, re.compile(v)) for k, v in IDENTIFIERS)
+_classifier = re.compile('|'.join('(?P<%s>%s)' % i for i in IDENTIFIERS))
+
 
 def validate(value, what=None):
     """
@@ -114,35 +158,159 @@ def validate(value, what=None):
     False
     >>> validate('MacBook Pro (Retina, Mid 2012)', 'productName')
     True
+    >>> validate('G135773004')
+    'dispatchId'
     """
-    result = None
-
     if not isinstance(value, basestring):
         raise ValueError('%s is not valid input' % value)
 
-    rex = {
-        'partNumber':       r'^([A-Z]{1,2})?\d{3}\-?(\d{4}|[A-Z]{1,2})(/[A-Z])?$',
-        'serialNumber':     r'^[A-Z0-9]{11,12}$',
-        'eeeCode':          r'^[A-Z0-9]{3,4}$',
-        'returnOrder':      r'^7\d{9}$',
-        'repairNumber':     r'^\d{12}$',
-        'dispatchId':       r'^G\d{9}$',
-        'alternateDeviceId': r'^\d{15}$',
-        'diagnosticEventNumber': r'^\d{23}$',
-        'productName':      r'^i?Mac',
+    if what:
+        pattern = _patterns.get(what)
+        return pattern is not None and pattern.match(value) is not None
+
+    m = _classifier.match(value)
+    return m.lastgroup if m else None
+
+
+def validate_many(values):
+    """
+    Classifies a sequence of values in one pass, returning
+    the kind of each value (or None) like validate() does.
+
+    >>> validate_many(['G135773004', '661-5097', 'blaa'])
+    ['dispatchId', 'partNumber', None]
+    """
+    match = _classifier.match
+    result = []
+
+    for value in values:
+        if not isinstance(value, basestring):
+            raise ValueError('%s is not valid input' % value)
+        m = match(value)
+        result.append(m.lastgroup if m else None)
+
+    return result
+
+
+_local = threading.local()
+_workers = None
+_workers_lock = threading.Lock()
+_session_cache = None
+_session_cache_lock = threading.Lock()
+
+
+def metrics():
+    "Returns the counters of the cache, retries and circuit breakers"
+    return {
+        'cache': GSX_CACHE.stats if GSX_CACHE is not None else None,
+        'retry': GSX_RETRY.stats,
+        'breakers': GSX_BREAKERS.stats,
     }
 
-    for k, v in rex.items():
-        if re.match(v, value):
-            result = k
 
-    return (result == what) if what else result
+def current_session():
+    "The session of this thread, or the one set up by the latest connect()"
+    return getattr(_local, 'session', None) or GSX_SESSION
+
+
+def in_session(func, session=None):
+    """
+    Wraps func to run in session (by default the current one),
+    no matter which thread ends up calling it
+    """
+    session = session or current_session()
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'session', None)
+        _local.session = session
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.session = previous
+
+    return wrapper
+
+
+def run_async(func, *args, **kwargs):
+    """
+    Runs func in the shared worker pool and returns an AsyncResult.
+    Call get() on the result to wait for the value (or the exception).
+
+    >>> run_async(validate, 'G135773004').get()
+    'dispatchId'
+    """
+    global _workers
+
+    with _workers_lock:
+        if _workers is None:
+            _workers = ThreadPool(GSX_WORKERS)
+
+    return _workers.apply_async(in_session(func), args, kwargs)
+
+
+class LocaleFormat(object):
+    """
+    Date and time formats of a GSX locale, with the
+    DD/MM/YY style patterns of langs.json compiled to strftime
+
+    >>> LocaleFormat('DD.MM.YYYY', 'HH:MM A').df
+    '%d.%m.%Y'
+    >>> LocaleFormat('DD.MM.YYYY', 'HH:MM A').tf
+    '%I:%M %p'
+    """
+    DATE_TOKENS = (('YYYY', '%Y'), ('YY', '%y'), ('MM', '%m'), ('DD', '%d'),)
+    TIME_TOKENS = (('HH', '%H'), ('MM', '%M'),)
+    AMPM_TOKENS = (('HH', '%I'), ('MM', '%M'), ('A', '%p'),)
+
+    def __init__(self, df, tf):
+        self.df = self._compile(df, self.DATE_TOKENS)
+        tokens = self.AMPM_TOKENS if 'A' in tf else self.TIME_TOKENS
+        self.tf = self._compile(tf, tokens)
+
+    def _compile(self, fmt, tokens):
+        if '%' not in fmt:
+            for k, v in tokens:
+                fmt = fmt.replace(k, v)
+        return fmt
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def date(self, value):
+        return value.strftime(self.df)
+
+    def time(self, value):
+        return value.strftime(self.tf)
 
 
-def get_format(locale=GSX_LOCALE):
-    filepath = os.path.join(os.path.dirname(__file__), 'langs.json')
-    df = open(filepath, 'r')
-    return json.load(df).get(locale)
+_locales = {}
+_locales_lock = threading.Lock()
+
+
+def get_format(locale=None):
+    """
+    Returns the LocaleFormat of locale, by default the one of the
+    current session. langs.json is read only once per process.
+
+    >>> get_format('en_GB').date(date(2013, 8, 12))
+    '12/08/13'
+    """
+    if not _locales:
+        with _locales_lock:
+            if not _locales:
+                filepath = os.path.join(os.path.dirname(__file__), 'langs.json')
+                with open(filepath, 'r') as fp:
+                    for k, v in json.load(fp).items():
+                        _locales[k] = LocaleFormat(v['df'], v['tf'])
+
+    if locale is None:
+        session = current_session()
+        locale = session._locale if session else GSX_LOCALE
+
+    # Fall back to the language default, then the global one
+    return (_locales.get(locale) or
+            _locales.get(locale[:2] + '_XXX') or
+            _locales[GSX_LOCALE])
 
 
 class GsxError(Exception):
@@ -185,141 +353,319 @@ class GsxError(Exception):
         return u' '.join(self.messages)
 
 
-class GsxCache(object):
+class ResponseStream(object):
     """
-    The cache creates a separate shelf for each GSX session.
-
-    >>> GsxCache('test').set('spam', 'eggs').get('spam')
-    'eggs'
+    The elements of a streamed response, parsed as they are read.
+    The response is closed and the call emitted when the elements
+    run out, on close() or once the stream is dropped, whichever
+    comes first, even if it was never iterated.
     """
-    shelf = None
-    tmpdir = tempfile.gettempdir()
+    def __init__(self, res, elements, call):
+        self._res = res
+        self._elements = elements
+        self._call = call
+
+    def __iter__(self):
+        return self
 
-    def __init__(self, key, expires=timedelta(minutes=20)):
-        self.key = key
-        self.expires = expires
-        self.now = datetime.now()
-        filename = os.path.join(self.tmpdir, "gsxws_%s" % key)
-        self.shelf = shelve.open(filename, protocol=-1)
+    def next(self):
+        call = self._call
 
-        if not self.shelf.get(key):
-            # Initialize the key
-            self.set(key, None)
+        if call is None:
+            raise StopIteration
 
-    def get(self, key):
         try:
-            d = self.shelf[key]
-            if d['expires'] > self.now:
-                return d['value']
-            else:
-                del self.shelf[key]
-        except KeyError:
-            return None
+            with call.phase('parse'):
+                return next(self._elements)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        call, self._call = self._call, None
+
+        if call is not None:
+            try:
+                self._res.close()
+            finally:
+                instrument.emit(call)
+
+    def __enter__(self):
+        return self
 
-    def set(self, key, value):
-        d = {
-            'value': value,
-            'expires': self.now + self.expires
-        }
+    def __exit__(self, *args):
+        self.close()
 
-        self.shelf[key] = d
-        return self
+    def __del__(self):
+        self.close()
 
 
 class GsxRequest(object):
     "Creates and submits the SOAP envelope"
-    env = None
     obj = None      # The GsxObject being submitted
-    data = None     # The GsxObject payload in XML format
-    body = None     # The Body part of the SOAP envelope
+    session = None  # The GsxSession this request is made in
 
     _request = ""
     _response = ""
+    _method = ""
+    _session_id = None  # Not set for Authenticate
+    _retries = 0
 
     def __init__(self, **kwargs):
-        "Construct the SOAP envelope"
         self.objects = []
-        self.env = ET.Element("soapenv:Envelope")
-        self.env.set("xmlns:core", "http://gsxws.apple.com/elements/core")
-        self.env.set("xmlns:glob", "http://gsxws.apple.com/elements/global")
-        self.env.set("xmlns:asp", "http://gsxws.apple.com/elements/core/asp")
-        self.env.set("xmlns:soapenv", "http://schemas.xmlsoap.org/soap/envelope/")
-        self.env.set("xmlns:emea", "http://gsxws.apple.com/elements/core/asp/emea")
-
-        ET.SubElement(self.env, "soapenv:Header")
-        self.body = ET.SubElement(self.env, "soapenv:Body")
 
         for k, v in kwargs.items():
             self.obj = v
+            self.session = v._session
             self._request = k
-            self.data = v.to_xml(self._request)
             self._response = k.replace("Request", "Response")
 
+    @property
+    def data(self):
+        "The GsxObject payload as an XML Element"
+        return self.obj.to_xml(self._request)
+
     def _send(self, method, xmldata):
-        "Send the final SOAP message"
-        global GSX_ENV, GSX_REGION, GSX_HOSTS, GSX_URL, GSX_TIMEOUT
+        "Send the final SOAP message, retrying calls that are safe to retry"
+        global GSX_HOSTS, GSX_URL, GSX_TIMEOUT, GSX_TRANSPORT, GSX_RETRY, GSX_BREAKERS
 
-        self._url = GSX_URL.format(env=GSX_HOSTS[GSX_ENV], region=GSX_REGION)
+        self._url = GSX_URL.format(env=GSX_HOSTS[self.session._env],
+                                   region=self.session._region)
         parsed = urlparse(self._url)
 
         logging.debug(self._url)
         logging.debug(xmldata)
 
-        ws = httplib.HTTPSConnection(parsed.netloc, timeout=GSX_TIMEOUT)
-        ws.putrequest("POST", parsed.path)
-        ws.putheader("User-Agent", "py-gsxws %s" % VERSION)
-        ws.putheader("Content-type", 'text/xml; charset="UTF-8"')
-        ws.putheader("Content-length", "%d" % len(xmldata))
-        ws.putheader("SOAPAction", '"%s"' % method)
-        ws.endheaders()
-        ws.send(xmldata)
+        headers = (
+            ("User-Agent", "py-gsxws %s" % VERSION),
+            ("Content-type", 'text/xml; charset="UTF-8"'),
+            ("Content-length", "%d" % len(xmldata)),
+            ("SOAPAction", '"%s"' % method),
+        )
+
+        endpoint = "%s/%s" % (self.session._env, self.session._region,)
+        breaker = GSX_BREAKERS.get(endpoint)
+        retries = GSX_RETRY.retries(method)
+        attempt = self._retries = 0
+
+        while True:
+            if not breaker.allow():
+                raise GsxError('GSX %s is unavailable' % endpoint)
+
+            try:
+                res = GSX_TRANSPORT.request(parsed.netloc, "POST", parsed.path,
+                                       xmldata, headers, timeout=GSX_TIMEOUT)
+            except Exception, e:
+                breaker.failure()
+                if attempt >= retries:
+                    GSX_RETRY.fail(method)
+                    raise GsxError('GSX connection failed: %s' % e)
+            else:
+                if res.status not in RETRY_STATUSES:
+                    breaker.success()
+                    return res
 
-        try:
-            return ws.getresponse()
-        except Exception, e:
-            raise GsxError('GSX connection failed: %s' % e)
+                breaker.failure()
+                if attempt >= retries:
+                    GSX_RETRY.fail(method)
+                    return res
 
-    def _submit(self, method, response=None, raw=False):
-        "Constructs and submits the final SOAP message"
-        global GSX_SESSION
+                res.close()
 
-        root = ET.SubElement(self.body, self.obj._namespace + method)
+            GSX_RETRY.wait(method, attempt)
+            attempt = self._retries = attempt + 1
+
+    def _submit(self, method, response=None, raw=False, stream=False):
+        """
+        Constructs and submits the final SOAP message.
+        With stream, returns a generator of response elements
+        that are parsed as the response comes in.
+        """
+        self._method = method
 
         if method is "Authenticate":
-            root.append(self.data)
-        else:
-            request_name = method + "Request"
-            request = ET.SubElement(root, request_name)
-            request.append(GSX_SESSION)
-
-            if self._request == request_name:
-                # Some requests lack a top-level container
-                request.extend(self.data)
-            else:
-                request.append(self.data)
+            self.session = self.obj
+            return self._call(method, response)
 
-        data = ET.tostring(self.env, "UTF-8")
-        res = self._send(method, data)
-        xml = res.read()
+        self.session = self.session or current_session()
 
-        if res.status > 200:
-            raise GsxError(xml=xml, url=self._url)
+        if self.session is None:
+            raise GsxError("Not connected to GSX")
 
-        logging.debug("Response: %s %s %s" % (res.status, res.reason, xml))
-        response = response or self._response
-        self.objects = objectify.parse(xml, response)
-        return self.objects
+        user_session = self.session.get_session()
+        self._session_id = user_session.find("userSessionId").text or ""
+
+        try:
+            return self._call(method, response, stream)
+        except GsxError, e:
+            if not set(e.codes) & set(SESSION_EXPIRED_CODES):
+                raise
+
+        # Log in again and retry once with the new session
+        self.session.refresh(self._session_id)
+        self._session_id = self.session._session_id
+        return self._call(method, response, stream)
+
+    def _message(self):
+        "The SOAP message, a serializer.Message if it includes files"
+        return serializer.message(serializer.write_message(
+            [], self.obj, self._method, self._request, self._session_id))
+
+    def serialize(self):
+        "Returns the complete SOAP message as UTF-8 encoded bytes"
+        return str(self._message())
+
+    def _call(self, method, response=None, stream=False):
+        "Sends the envelope (or finds it in the cache) and parses the response"
+        global GSX_CACHE, GSX_MODELS
+
+        xml, key = None, None
+        call = instrument.Call(method, self.session._env, self.session._region)
+
+        try:
+            if GSX_CACHE is not None and GSX_CACHE.cacheable(method):
+                key = GSX_CACHE.key(method, (self.session._env, self.session._region,
+                                             self.session.userId,
+                                             self.session.serviceAccountNo,
+                                             self._request, self.obj._namespace,
+                                             self.obj._data,))
+                if not self.obj._fresh:
+                    xml = GSX_CACHE.get(key)
+
+            response = response or self._response
+            call.cached = xml is not None
+            model = responses.get_model(method, response) if GSX_MODELS else None
+
+            if xml is None:
+                with call.phase('serialize'):
+                    message = self._message()
+
+                call.request_bytes = len(message)
+                res = self._send(method, message)
+                call.status, call.retries = res.status, self._retries
+                call.phases.update(getattr(res, 'timings', {}))
+
+                if stream and res.status == 200:
+                    # Emitted once the stream has been consumed or dropped
+                    if model is not None:
+                        elements = responses.iterparse(res, model)
+                    else:
+                        elements = objectify.iterparse(res, response)
+                    streaming, call = call, None
+                    return ResponseStream(res, elements, streaming)
+
+                with call.phase('read'):
+                    xml = res.read()
+
+                call.response_bytes = len(xml)
+
+                if res.status > 200:
+                    try:
+                        error = GsxError(xml=xml, url=self._url)
+                    except ET.ParseError:
+                        # Not from GSX, like the error page of a proxy
+                        error = GsxError("HTTP %d %s" % (res.status, res.reason))
+                    raise error
+
+                logging.debug("Response: %s %s %s" % (res.status, res.reason, xml))
+
+                if key is not None:
+                    GSX_CACHE.set(key, xml, method)
+
+            if stream:
+                if model is not None:
+                    return responses.iterparse(xml, model)
+                return objectify.iterparse(xml, response)
+
+            with call.phase('parse'):
+                if model is not None:
+                    self.objects = responses.parse(xml, model)
+                else:
+                    self.objects = objectify.parse(xml, response)
+
+            return self.objects
+        except GsxError, e:
+            call.fail(e)
+            raise
+        finally:
+            if call is not None:
+                instrument.emit(call)
 
     def __unicode__(self):
-        return ET.tostring(self.env)
+        return self.serialize().decode("utf-8")
 
     def __str__(self):
         return unicode(self).encode('utf-8') 
 
 
+def _set_file(obj, value):
+    if not hasattr(obj, "fileName"):
+        obj.fileName = value.name
+
+    # Encoded in chunks while sending
+    return serializer.FileData(value)
+
+
+def _set_bool(obj, value):
+    return "Y" if value else "N"
+
+
+def _set_int(obj, value):
+    return str(value)
+
+
+def _set_date(obj, value):
+    return obj._formats.date(value)
+
+
+def _set_time(obj, value):
+    return obj._formats.time(value)
+
+
+_setters = {}
+
+
+def get_setter(value):
+    """
+    Returns the function that converts values of this type
+    when they're assigned to a GsxObject, or None.
+    Resolved once per type, unless it depends on the instance.
+    """
+    t = type(value)
+
+    try:
+        return _setters[t]
+    except KeyError:
+        pass
+
+    # Kind of a lame way to identify files, but it's the best
+    # we have for Django's File class right now...
+    if hasattr(value, "fileno"):
+        setter = _set_file
+    elif isinstance(value, bool):
+        setter = _set_bool
+    elif isinstance(value, int):
+        setter = _set_int
+    elif isinstance(value, date):
+        setter = _set_date
+    elif isinstance(value, time):
+        setter = _set_time
+    else:
+        setter = None
+
+    # Instances with attributes of their own may or may not have a fileno
+    if hasattr(t, "fileno") or not (hasattr(value, "__dict__") or
+                                    hasattr(t, "__getattr__")):
+        _setters[t] = setter
+
+    return setter
+
+
 class GsxObject(object):
     "XML/SOAP representation of a GSX object"
     _data = {}
+    _session = None     # Submit in this GsxSession instead of the current one
+    _fresh = False      # Skip the response cache (the response is still cached)
 
     def __init__(self, *args, **kwargs):
         self._data = {}
@@ -339,40 +685,37 @@ class GsxObject(object):
             super(GsxObject, self).__setattr__(name, value)
             return
 
-        # Kind of a lame way to identify files, but it's the best
-        # we have for Django's File class right now...
-        if hasattr(value, "fileno"):
-            if not hasattr(self, "fileName"):
-                self.fileName = value.name
-
-            value = base64.b64encode(value.read())
-
-        if isinstance(value, bool):
-            value = "Y" if value else "N"
+        setter = get_setter(value)
 
-        if isinstance(value, int):
-            value = str(value)
-
-        if isinstance(value, date):
-            value = value.strftime(self._formats['df'])
-
-        if isinstance(value, time):
-            value = value.strftime(self._formats['tf'])
+        if setter is not None:
+            value = setter(self, value)
 
         self._data[name] = value
 
+    def _items(self):
+        "The (name, value) pairs of the fields, in serialization order"
+        return self._data.items()
+
     def __getattr__(self, name):
         try:
             return self._data[name]
         except KeyError:
             raise AttributeError("Invalid attribute: %s" % name)
 
-    def _submit(self, arg, method, ret=None, raw=False):
+    def _submit(self, arg, method, ret=None, raw=False, stream=False):
         "Shortcut for submitting a GsxObject"
         self._req = GsxRequest(**{arg: self})
-        result = self._req._submit(method, ret, raw)
+        result = self._req._submit(method, ret, raw, stream)
+
+        if stream or result is None:
+            return result
+
         return result if len(result) > 1 else result[0]
 
+    def _submit_async(self, arg, method, ret=None, raw=False):
+        "Non-blocking version of _submit, returns an AsyncResult"
+        return run_async(self._submit, arg, method, ret, raw)
+
     def to_xml(self, root):
         """
         Returns this object as an XML Element
@@ -383,24 +726,162 @@ class GsxObject(object):
         <Element 'blaa' at 0x...
         """
         root = ET.Element(root)
-        for k, v in self._data.items():
+        for k, v in self._items():
             if isinstance(v, list):
                 for e in v:
                     if isinstance(e, GsxObject):
                         i = ET.SubElement(root, k)
                         i.extend(e.to_xml(k))
+                    elif isinstance(e, basestring):
+                        ET.SubElement(root, k).text = e
             else:
                 el = ET.SubElement(root, k)
                 if isinstance(v, basestring):
                     el.text = v
+                if isinstance(v, serializer.FileData):
+                    el.text = str(v) or None
                 if isinstance(v, GsxObject):
                     el.extend(v.to_xml(k))
 
         return root
 
     def dumps(self):
-        req = GsxRequest(**{'GsxObject': self})
-        return ET.tostring(req.data, encoding='utf-8')
+        return serializer.dumps('GsxObject', self)
+
+
+class RecordType(type):
+    """
+    Adds the _fields of a GsxRecord class to its __slots__,
+    class attributes of the same name become the defaults
+    """
+    def __new__(mcs, name, bases, attrs):
+        fields, defaults = (), {}
+
+        for base in bases:
+            fields += tuple(f for f in getattr(base, '_fields', ()) if f not in fields)
+            defaults.update(getattr(base, '_defaults', {}))
+
+        own = tuple(f for f in attrs.get('_fields', ()) if f not in fields)
+        fields += own
+
+        for f in fields:
+            if f in attrs:
+                defaults[f] = attrs.pop(f)
+
+        attrs['__slots__'] = tuple(attrs.get('__slots__', ())) + own
+        attrs['_fields'] = fields
+        attrs['_fieldset'] = frozenset(fields)
+        attrs['_defaults'] = defaults
+        return type.__new__(mcs, name, bases, attrs)
+
+
+class GsxRecord(GsxObject):
+    """
+    A GsxObject with a fixed set of fields (_fields) that are kept
+    in __slots__ instead of a dict. Much smaller and faster to build,
+    which matters for large orders and bulk imports.
+    Fields outside the schema still work, but take the slow path
+    (a dict in _extra, created for the first one).
+
+    >>> class Line(GsxRecord):
+    ...     _fields = ('partNumber', 'quantity',)
+    ...     quantity = "1"
+    >>> line = Line(partNumber='661-5097')
+    >>> line.quantity, line._data
+    ('1', {'partNumber': '661-5097'})
+    """
+    __metaclass__ = RecordType
+    __slots__ = ('_formats', '_extra',)
+
+    def __init__(self, *args, **kwargs):
+        self._formats = get_format()
+
+        for a in args:
+            k = validate(a)
+            if k is not None:
+                kwargs[k] = a
+
+        for k, v in kwargs.items():
+            self.__setattr__(k, v)
+
+    def __setattr__(self, name, value):
+        if name[0] != "_":
+            setter = get_setter(value)
+            if setter is not None:
+                value = setter(self, value)
+
+            if name not in self._fieldset:
+                self._set_extra(name, value)
+                return
+
+        object.__setattr__(self, name, value)
+
+    def _set_extra(self, name, value):
+        try:
+            extra = object.__getattribute__(self, '_extra')
+        except AttributeError:
+            extra = {}
+            object.__setattr__(self, '_extra', extra)
+
+        extra[name] = value
+
+    def __getattr__(self, name):
+        # Only called for fields that haven't been set and extra fields
+        try:
+            return self._defaults[name]
+        except KeyError:
+            pass
+
+        try:
+            return object.__getattribute__(self, '_extra')[name]
+        except (AttributeError, KeyError):
+            raise AttributeError("Invalid attribute: %s" % name)
+
+    def __delattr__(self, name):
+        try:
+            object.__delattr__(self, name)
+            return
+        except AttributeError:
+            pass
+
+        try:
+            del object.__getattribute__(self, '_extra')[name]
+        except (AttributeError, KeyError):
+            raise AttributeError("Invalid attribute: %s" % name)
+
+    def _items(self):
+        items = []
+
+        for f in self._fields:
+            try:
+                items.append((f, object.__getattribute__(self, f),))
+            except AttributeError:
+                pass
+
+        try:
+            items.extend(object.__getattribute__(self, '_extra').items())
+        except AttributeError:
+            pass
+
+        return items
+
+    @property
+    def _data(self):
+        "The set fields as a dict (a copy)"
+        return dict(self._items())
+
+    def __getstate__(self):
+        state = dict(self._items())
+        state.update(getattr(self, '__dict__', {}))
+        state['_formats'] = self._formats
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            if k[0] != "_" and k not in self._fieldset:
+                self._set_extra(k, v)
+            else:
+                object.__setattr__(self, k, v)
 
 
 class GsxRequestObject(GsxObject):
@@ -408,13 +889,32 @@ class GsxRequestObject(GsxObject):
     pass
 
 
-class GsxSession(GsxObject):
+def session_cache():
+    "The GsxCache that all GsxSessions share to store their logins"
+    global _session_cache
 
+    with _session_cache_lock:
+        if _session_cache is None:
+            _session_cache = GsxCache("sessions")
+
+    return _session_cache
+
+
+class GsxSession(GsxObject):
+    """
+    A GSX session of one account in one environment and region.
+    Sessions are refreshed ahead of expiry and only one thread
+    at a time will (re-)authenticate.
+    """
     _cache = None
     _namespace = "glob:"
 
-    def __init__(self, user_id, password, sold_to, language, timezone):
-        global GSX_ENV
+    lifetime = timedelta(minutes=20)
+    refresh_before = timedelta(minutes=2)
+
+    def __init__(self, user_id, password, sold_to, language, timezone,
+                 environment=None, region=None, locale=None):
+        super(GsxSession, self).__init__()
 
         self.userId = user_id
         self.password = password
@@ -422,39 +922,111 @@ class GsxSession(GsxObject):
         self.userTimeZone = timezone
         self.serviceAccountNo = str(sold_to)
 
+        self._env = environment or GSX_ENV
+        self._region = region or GSX_REGION
+        self._locale = locale or GSX_LOCALE
+        self._session = self
         self._session_id = ""
+        self._expires = datetime.min
+        self._lock = threading.Lock()
 
         md5 = hashlib.md5()
-        md5.update(user_id + self.serviceAccountNo + GSX_ENV)
+        md5.update(user_id + self.serviceAccountNo + self._env + self._region)
 
         self._cache_key = md5.hexdigest()
-        self._cache = GsxCache(self._cache_key)
+        self._cache = session_cache()
+
+    @property
+    def is_valid(self):
+        return bool(self._session_id) and datetime.now() < self._expires
+
+    def _authenticate(self):
+        # Another process may have logged in already
+        cached = self._cache.get(self._cache_key)
+
+        if cached is not None and cached[1] - self.refresh_before > datetime.now():
+            self._session_id, self._expires = cached
+            return
+
+        self._req = GsxRequest(AuthenticateRequest=self)
+        result = self._req._submit("Authenticate")
+        self._session_id = str(result.userSessionId)
+        self._expires = datetime.now() + self.lifetime
+        self._cache.set(self._cache_key, (self._session_id, self._expires,),
+                        self.lifetime)
 
     def get_session(self):
+        """
+        Returns the userSession element, logging in again
+        if the session has expired or is about to
+        """
+        if not self.is_valid:
+            self.login()
+        elif datetime.now() > self._expires - self.refresh_before:
+            # Still valid, so don't wait if someone else is already on it
+            if self._lock.acquire(False):
+                try:
+                    self._authenticate()
+                except GsxError, e:
+                    logging.debug("Session refresh failed: %s" % e)
+                finally:
+                    self._lock.release()
+
         session = ET.Element("userSession")
         session_id = ET.SubElement(session, "userSessionId")
         session_id.text = self._session_id
         return session
 
     def login(self):
-        global GSX_SESSION
-        session = self._cache.get("session")
+        with self._lock:
+            if not self.is_valid:
+                self._authenticate()
 
-        if not session is None:
-            GSX_SESSION = session
-        else:
-            self._req = GsxRequest(AuthenticateRequest=self)
-            result = self._req._submit("Authenticate")
-            self._session_id = str(result.userSessionId)
-            GSX_SESSION = self.get_session()
-            self._cache.set("session", GSX_SESSION)
+        return self.get_session()
 
-        return GSX_SESSION
+    def refresh(self, session_id=None):
+        """
+        Logs in again after session_id was rejected by GSX,
+        unless another thread has already replaced it
+        """
+        with self._lock:
+            if session_id is None or session_id == self._session_id:
+                self._cache.delete(self._cache_key)
+                self._session_id = ""
+                self._authenticate()
+
+        return self.get_session()
 
     def logout(self):
         return GsxRequest(LogoutRequest=self)
 
 
+class GsxSessionPool(object):
+    "Keeps one GsxSession per user, sold-to, environment and region"
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, password, sold_to, environment=None, region=None,
+            language=None, timezone="CEST", locale=None):
+        environment = environment or GSX_ENV
+        region = region or GSX_REGION
+        key = (user_id, str(sold_to), environment, region,)
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.password != password:
+                session = GsxSession(user_id, password, sold_to,
+                                     language or GSX_LANG, timezone,
+                                     environment, region, locale)
+                self._sessions[key] = session
+
+        return session
+
+
+GSX_SESSIONS = GsxSessionPool()
+
+
 def connect(user_id, password, sold_to,
             environment=GSX_ENV,
             language=GSX_LANG,
@@ -464,19 +1036,25 @@ def connect(user_id, password, sold_to,
     """
     Establishes connection with GSX Web Services.
     Returns the session ID of the new connection.
+    The session becomes the current one of this thread and
+    the default for threads that haven't connected themselves.
     """
     global GSX_ENV
     global GSX_LANG
     global GSX_LOCALE
     global GSX_REGION
+    global GSX_SESSION
 
     GSX_LANG = language
     GSX_REGION = region
     GSX_LOCALE = locale
     GSX_ENV = environment
 
-    act = GsxSession(user_id, password, sold_to, language, timezone)
-    return act.login()
+    act = GSX_SESSIONS.get(user_id, password, sold_to, environment, region,
+                           language, timezone, locale)
+    session = act.login()
+    GSX_SESSION = _local.session = act
+    return session
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+gsxws/instrument.py
+
+Timings and sizes of every GSX call. Each call is described by a Call
+that is passed to the registered hooks once the call is done:
+
+    >>> collector = Collector()
+    >>> add_hook(collector)
+    ... make some calls ...
+    >>> collector.snapshot()['WarrantyStatus']['latency']['p99']  #doctest: +SKIP
+    0.215
+"""
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# The phases of a call, in order
+PHASES = ('serialize', 'connect', 'send', 'wait', 'read', 'parse',)
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+class Call(object):
+    """
+    One GSX call. phases has the seconds spent in each of PHASES
+    (a cached response skips the network ones), faults has the
+    fault codes of a failed call.
+    """
+    def __init__(self, method, env=None, region=None):
+        self.method = method
+        self.env = env
+        self.region = region
+        self.phases = {}
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.retries = 0
+        self.cached = False
+        self.faults = []
+        self.error = None
+        self.started = time.time()
+        self.duration = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - started
+
+    def fail(self, error):
+        self.error = error
+        self.faults = list(getattr(error, 'codes', []))
+
+    def __repr__(self):
+        return "<Call %s %s %.3fs>" % (self.method, self.status, self.duration or 0)
+
+
+def add_hook(hook):
+    "Calls hook(call) after each GSX call"
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def emit(call):
+    "Finishes call and passes it to the hooks"
+    call.duration = time.time() - call.started
+
+    for hook in list(_hooks):
+        try:
+            hook(call)
+        except Exception, e:
+            logging.exception("Instrumentation hook %r failed: %s" % (hook, e))
+
+
+def _bounds(low=0.0005, high=120, factor=1.2):
+    bounds = [low]
+    while bounds[-1] < high:
+        bounds.append(bounds[-1] * factor)
+    return bounds
+
+
+class Histogram(object):
+    """
+    Counts values in exponentially growing buckets (0.5 ms to 2 min by
+    default), so percentiles are accurate to within the bucket width.
+
+    >>> h = Histogram()
+    >>> for i in range(1, 101): h.observe(i / 100.0)
+    >>> 0.45 < h.percentile(50) < 0.55
+    True
+    """
+    BOUNDS = _bounds()
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds or self.BOUNDS
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+
+        rank = self.count * p / 100.0
+        seen = 0
+
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.bounds[i - 1] if i > 0 else 0.0
+                high = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(low + (high - low) * (rank - seen) / n, self.max)
+            seen += n
+
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Collector(object):
+    "A hook that keeps latency histograms and counters per operation"
+    def __init__(self):
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, call):
+        with self._lock:
+            op = self._operations.get(call.method)
+
+            if op is None:
+                op = {'latency': Histogram(), 'phases': {}, 'faults': {},
+                      'errors': 0, 'cached': 0, 'retries': 0,
+                      'request_bytes': 0, 'response_bytes': 0}
+                self._operations[call.method] = op
+
+            op['latency'].observe(call.duration)
+
+            for name, seconds in call.phases.items():
+                op['phases'].setdefault(name, Histogram()).observe(seconds)
+
+            for code in call.faults:
+                op['faults'][code] = op['faults'].get(code, 0) + 1
+
+            op['errors'] += call.error is not None
+            op['cached'] += call.cached
+            op['retries'] += call.retries
+            op['request_bytes'] += call.request_bytes
+            op['response_bytes'] += call.response_bytes
+
+    def snapshot(self):
+        "The statistics of each operation, for exporting"
+        with self._lock:
+            result = {}
+            for method, op in self._operations.items():
+                result[method] = dict(op,
+                                      faults=dict(op['faults']),
+                                      latency=op['latency'].summary(),
+                                      phases=dict((k, v.summary()) for k, v
+                                                  in op['phases'].items()))
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._operations = {}
@@ -1,11 +1,30 @@
 # -*- coding: utf-8 -*-
 
+import Queue
 import base64
 import logging
 import tempfile
-from datetime import date
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
 
-from core import GsxObject, connect
+from core import GsxObject, connect, run_async, in_session
+
+# The most repairs RepairLookup returns for one query
+REPAIR_LOOKUP_LIMIT = 2500
+
+
+def split_range(start, end):
+    """
+    Splits the dates from start to end (inclusive) in two halves,
+    or returns None if it's a single day
+
+    >>> split_range(date(2013, 1, 1), date(2013, 1, 31))
+    ((datetime.date(2013, 1, 1), datetime.date(2013, 1, 16)), (datetime.date(2013, 1, 17), datetime.date(2013, 1, 31)))
+    """
+    if start >= end:
+        return None
+    middle = start + timedelta(days=(end - start).days // 2)
+    return (start, middle,), (middle + timedelta(days=1), end,)
 
 
 class Lookup(GsxObject):
@@ -13,11 +32,15 @@ class Lookup(GsxObject):
         super(Lookup, self).__init__(*args, **kwargs)
         self._namespace = "asp:"
 
-    def lookup(self, method, response="lookupResponseData"):
-        result = self._submit("lookupRequestData", method, response)
+    def lookup(self, method, response="lookupResponseData", stream=False):
+        """
+        With stream, returns a generator that yields each response
+        element as soon as it has been received and parsed
+        """
+        result = self._submit("lookupRequestData", method, response, stream=stream)
         return [result] if isinstance(result, dict) else result
 
-    def parts(self):
+    def parts(self, stream=False):
         """
         The Parts Lookup API allows users to access part and part pricing data prior to
         creating a repair or order. Parts lookup is also a good way to search for
@@ -25,9 +48,13 @@ class Lookup(GsxObject):
         (config code, EEE code, serial number, etc.).
         """
         self._namespace = "core:"
-        return self.lookup("PartsLookup", "parts")
+        return self.lookup("PartsLookup", "parts", stream)
+
+    def parts_async(self):
+        "Non-blocking version of parts()"
+        return run_async(self.parts)
 
-    def repairs(self):
+    def repairs(self, stream=False):
         """
         The Repair Lookup API mimics the front-end repair search functionality.
         It fetches up to 2500 repairs in a given criteria.
@@ -37,7 +64,73 @@ class Lookup(GsxObject):
         >>> Lookup(serialNumber='DGKFL06JDHJP').repairs() # doctest: +ELLIPSIS
         [{'customerName': 'Lepalaan,Filipp',...
         """
-        return self.lookup("RepairLookup")
+        return self.lookup("RepairLookup", stream=stream)
+
+    def repairs_async(self):
+        "Non-blocking version of repairs()"
+        return run_async(self.repairs)
+
+    def _repairs_between(self, start, end):
+        "Returns ((start, end), repairs or the error) for repairs_all()"
+        criteria = dict(self._data, fromDate=start, toDate=end)
+        try:
+            repairs = Lookup(**criteria).repairs()
+        except Exception, e:
+            return (start, end,), e
+
+        # None when there are no repairs, iterating a GsxElement
+        # yields it and its siblings, so a single repair is a list too
+        return (start, end,), [] if repairs is None else list(repairs)
+
+    def repairs_all(self, from_date, to_date, concurrency=4,
+                    limit=REPAIR_LOOKUP_LIMIT):
+        """
+        Yields every repair matching this criteria between from_date
+        and to_date, even past the limit of one RepairLookup.
+        Date ranges whose lookup hits the limit are split in half
+        and looked up again, with up to concurrency lookups running
+        at a time. Repairs are yielded as they arrive, once per
+        repair confirmation number.
+
+        >>> for r in Lookup(shipToCode=677592).repairs_all(date(2013, 1, 1), date(2013, 12, 31)):
+        ...     print r.repairConfirmationNumber # doctest: +SKIP
+        """
+        results = Queue.Queue()
+        pool = ThreadPool(concurrency)
+        lookup = in_session(self._repairs_between)
+        seen = set()
+        pending = [0]
+
+        def submit(start, end):
+            pending[0] += 1
+            pool.apply_async(lookup, (start, end,), callback=results.put)
+
+        submit(from_date, to_date)
+
+        try:
+            while pending[0]:
+                (start, end,), repairs = results.get()
+                pending[0] -= 1
+
+                if isinstance(repairs, Exception):
+                    raise repairs
+
+                if len(repairs) >= limit:
+                    halves = split_range(start, end)
+                    if halves:
+                        for half in halves:
+                            submit(*half)
+                    else:
+                        logging.warning("RepairLookup hit the limit of %d on %s, "
+                                        "some repairs are missing" % (limit, start,))
+
+                for r in repairs:
+                    key = unicode(r.repairConfirmationNumber)
+                    if key not in seen:
+                        seen.add(key)
+                        yield r
+        finally:
+            pool.terminate()
 
     def invoices(self):
         """
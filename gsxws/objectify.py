@@ -2,10 +2,13 @@
 
 import os
 import re
+import atexit
 import base64
+import weakref
 import tempfile
+from cStringIO import StringIO
 
-from lxml import objectify
+from lxml import etree, objectify
 from datetime import datetime
 
 DATETIME_TYPES = ('dispatchSentDate',)
@@ -55,11 +58,97 @@ def gsx_price(value):
     return float(re.sub(r'[A-Z ,]', '', value))
 
 
+# Paths of the decoded attachments that haven't been closed yet
+_decoded = set()
+
+
+@atexit.register
+def _remove_decoded():
+    "Removes the files of the attachments that were never closed"
+    for path in list(_decoded):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        _decoded.discard(path)
+
+
+class GsxAttachment(object):
+    """
+    A base64-encoded file in a GSX response. Nothing is decoded
+    until the file is needed, and then it's decoded only once,
+    in chunks, to a temporary file. The file stays around until
+    close() is called or the process exits, even if the attachment
+    itself is gone, so its path can be passed on.
+
+    >>> a = GsxAttachment('c3BhbSBhbmQgZWdncw==')
+    >>> a.size
+    13
+    >>> a.bytes
+    'spam and eggs'
+    """
+    chunk_size = 4 * 16384
+
+    def __init__(self, value, suffix=".pdf"):
+        self._value = value
+        self._path = None
+        self.suffix = suffix
+
+    @property
+    def encoded(self):
+        if re.search(r'\s', self._value):
+            self._value = ''.join(self._value.split())
+        return self._value
+
+    @property
+    def size(self):
+        "Size of the decoded file, without decoding it"
+        encoded = self.encoded
+        return len(encoded) / 4 * 3 - encoded[-2:].count('=')
+
+    @property
+    def path(self):
+        if self._path is None:
+            encoded = self.encoded
+            of = tempfile.NamedTemporaryFile(suffix=self.suffix, delete=False)
+            with of:
+                for i in xrange(0, len(encoded), self.chunk_size):
+                    of.write(base64.b64decode(encoded[i:i + self.chunk_size]))
+            self._path = of.name
+            _decoded.add(self._path)
+
+        return self._path
+
+    @property
+    def bytes(self):
+        with self.open() as fp:
+            return fp.read()
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def close(self):
+        "Removes the decoded file"
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            _decoded.discard(self._path)
+            self._path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __str__(self):
+        return self.path
+
+
 def gsx_attachment(value):
-    v = base64.b64decode(value)
-    of = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
-    of.write(v)
-    return of.name
+    return GsxAttachment(value)
 
 
 def gsx_datetime(value):
@@ -74,10 +163,74 @@ def gsx_timestamp(value):
     return datetime.strptime(value, "%d-%b-%y %H:%M:%S")
 
 
+def gsx_text(value):
+    if value == 'Y' or value == 'N':
+        return gsx_boolean(value)
+    return value
+
+
+# Converters for specific tags, see register_converter()
+CONVERTERS = dict(
+    [(t, gsx_datetime) for t in DATETIME_TYPES] +
+    [(t, gsx_attachment) for t in BASE64_TYPES] +
+    [(t, gsx_price) for t in FLOAT_TYPES]
+)
+
+_resolved = {}
+
+
+def register_converter(tag, func):
+    """
+    Makes GsxElement convert the text of tag elements with func.
+
+    >>> register_converter('repairCount', int)
+    """
+    CONVERTERS[tag] = func
+    _resolved.clear()
+
+
+def get_converter(tag):
+    "Returns the converter of tag, looking it up only once per tag"
+    try:
+        return _resolved[tag]
+    except KeyError:
+        pass
+
+    if tag in CONVERTERS:
+        converter = CONVERTERS[tag]
+    elif tag.endswith('Date'):
+        converter = gsx_date
+    else:
+        converter = gsx_text
+
+    _resolved[tag] = converter
+    return converter
+
+
+_getattribute = objectify.ObjectifiedElement.__getattribute__
+
+# The converted values of each GsxElement. lxml creates and drops the
+# proxies of elements as it likes, so they can't hold any state.
+_values = weakref.WeakKeyDictionary()
+
+
 class GsxElement(objectify.ObjectifiedElement):
+    """
+    Converts the values of data elements on access, keeping them
+    around as long as this element so they're only converted once.
+    """
+    def __setattr__(self, name, value):
+        _values.get(self, {}).pop(name, None)
+        super(GsxElement, self).__setattr__(name, value)
+
     def __getattribute__(self, name):
+        values = _values.get(self)
+
+        if values is not None and name in values:
+            return values[name]
+
         try:
-            result = super(GsxElement, self).__getattribute__(name)
+            result = _getattribute(self, name)
         except AttributeError:
             """
             The XML returned by GSX can be pretty inconsistent, especially
@@ -88,28 +241,28 @@ class GsxElement(objectify.ObjectifiedElement):
             return
 
         if isinstance(result, objectify.NumberElement):
-            return result.pyval
+            value = result.pyval
+        elif isinstance(result, objectify.StringElement):
+            value = unicode(result.text or '')
+            if value:
+                value = get_converter(result.tag)(value)
+            else:
+                value = None
+        else:
+            return result
 
-        if isinstance(result, objectify.StringElement):
-            name = result.tag
-            result = result.text or ''
-            result = unicode(result)
+        if values is None:
+            values = _values.setdefault(self, {})
 
-            if not result:
-                return
+        values[name] = value
+        return value
 
-            if name in DATETIME_TYPES:
-                return gsx_datetime(result)
-            if name in BASE64_TYPES:
-                return gsx_attachment(result)
-            if name in FLOAT_TYPES:
-                return gsx_price(result)
-            if name.endswith('Date'):
-                return gsx_date(result)
-            if re.search(r'^[YN]$', result):
-                return gsx_boolean(result)
 
-        return result
+def makeparser():
+    parser = objectify.makeparser(remove_blank_text=True)
+    lookup = objectify.ObjectifyElementClassLookup(tree_class=GsxElement)
+    parser.set_element_class_lookup(lookup)
+    return parser
 
 
 def parse(root, response):
@@ -122,9 +275,7 @@ def parse(root, response):
     True
     >>> parse('tests/fixtures/warranty_status.xml', 'warrantyDetailInfo').isPersonalized
     """
-    parser = objectify.makeparser(remove_blank_text=True)
-    lookup = objectify.ObjectifyElementClassLookup(tree_class=GsxElement)
-    parser.set_element_class_lookup(lookup)
+    parser = makeparser()
 
     if isinstance(root, basestring) and os.path.exists(root):
         root = objectify.parse(root, parser)
@@ -133,6 +284,48 @@ def parse(root, response):
 
     return root.find('*//%s' % response)
 
+
+def iterparse(source, response, chunk_size=16384):
+    """
+    Parses source (a filename, a file-like object or an XML string)
+    incrementally and yields every response element as soon as it's
+    complete. Processed elements are dropped as parsing goes on.
+
+    >>> [p.partNumber for p in iterparse('tests/fixtures/parts_lookup.xml', 'parts')]
+    [u'661-4448', u'661-4954', u'661-5028']
+    """
+    if isinstance(source, basestring):
+        if os.path.exists(source):
+            # Closed when parsing ends or the generator is dropped
+            with open(source, 'rb') as fp:
+                for el in iterparse(fp, response, chunk_size):
+                    yield el
+            return
+
+        source = StringIO(source)
+
+    parser = makeparser()
+    pull = etree.XMLPullParser(events=('end',), tag=response, remove_blank_text=True)
+
+    while True:
+        data = source.read(chunk_size)
+
+        if data:
+            pull.feed(data)
+        else:
+            pull.close()
+
+        for event, el in pull.read_events():
+            # Elements built by the pull parser can't be objectified
+            yield objectify.fromstring(etree.tostring(el), parser)
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
+        if not data:
+            break
+
+
 if __name__ == '__main__':
     import doctest
     import logging
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from core import GsxObject
+from core import GsxObject, GsxRecord
 
 
-class OrderLine(GsxObject):
+class OrderLine(GsxRecord):
+    _fields = ('partNumber', 'quantity',)
+
     partNumber = None
     quantity = None
 
@@ -3,22 +3,110 @@
 """
 https://gsxwsut.apple.com/apidocs/ut/html/WSAPIChangeLog.html?user=asp
 """
+import time
+import Queue
 import urllib
+from multiprocessing.pool import ThreadPool
 
 from lookups import Lookup
+from catalog import CATALOG
 from diagnostics import Diagnostics
-from core import GsxObject, GsxError, validate
+from core import GsxObject, GsxError, validate, run_async, in_session
 
 
 def models():
     """
-    >>> models() # doctest: +ELLIPSIS
-    {'IPODCLASSIC': {'models': ['iPod 5th Generation (Late 2006)', ...
+    Returns the product lines and their models from products.yaml.
+    See catalog.CATALOG for the indexed lookups.
+
+    >>> models()['IPODCLASSIC'] # doctest: +ELLIPSIS
+    {'models': ['iPod 5th Generation (Late 2006)', ...
+    """
+    return CATALOG.models()
+
+
+class WarrantyProgress(object):
+    "Progress and throughput of a warranty_many() run"
+    def __init__(self):
+        self.done = 0
+        self.errors = 0
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        "Checks per second"
+        return self.done / (self.elapsed or 1e-9)
+
+    def __str__(self):
+        return "%d done, %d errors, %.1f/s" % (self.done, self.errors, self.rate)
+
+
+def _check_warranty(sn):
+    "Returns (sn, warrantyDetailInfo or the exception) for warranty_many()"
+    try:
+        return sn, Product(sn).warranty()
+    except GsxError, e:
+        return sn, e
+    except ValueError, e:
+        return sn, GsxError(str(e))
+    except Exception, e:
+        return sn, e
+
+
+def warranty_many(serials, concurrency=8, progress=None):
     """
-    import os
-    import yaml
-    filepath = os.path.join(os.path.dirname(__file__), "products.yaml")
-    return yaml.load(open(filepath, 'r'))
+    Checks the warranty of many serial numbers or IMEIs, running
+    up to concurrency requests at a time. Yields (serial, result)
+    tuples in the order they complete, where result is either the
+    warrantyDetailInfo or the exception raised for that serial
+    (a GsxError for anything GSX rejects). serials can be any
+    iterable, it's read only as fast as the checks complete.
+    progress is called with a WarrantyProgress after every result.
+
+    >>> for sn, result in warranty_many(['DGKFL06JDHJP', '013348005376007']):
+    ...     print sn, result.warrantyStatus # doctest: +SKIP
+    """
+    stats = WarrantyProgress()
+    results = Queue.Queue()
+    pool = ThreadPool(concurrency)
+    check = in_session(_check_warranty)
+    serials = iter(serials)
+    pending = [0]
+
+    def submit():
+        "Starts the next check, returns False if there are no serials left"
+        try:
+            sn = next(serials)
+        except StopIteration:
+            return False
+
+        pending[0] += 1
+        pool.apply_async(check, (sn,), callback=results.put)
+        return True
+
+    # Keep the pool busy without reading ahead more than that
+    for i in range(concurrency * 2):
+        if not submit():
+            break
+
+    try:
+        while pending[0]:
+            sn, result = results.get()
+            pending[0] -= 1
+            submit()
+
+            stats.done += 1
+            if isinstance(result, Exception):
+                stats.errors += 1
+            if progress is not None:
+                progress(stats)
+            yield sn, result
+    finally:
+        pool.terminate()
 
 
 class Product(object):
@@ -48,6 +136,10 @@ class Product(object):
         self.configCode = result.configCode
         return result
 
+    def model_async(self):
+        "Non-blocking version of model()"
+        return run_async(self.model)
+
     def warranty(self, parts=[]):
         """
         The Warranty Status API retrieves the same warranty details
@@ -86,6 +178,15 @@ class Product(object):
 
         return self.warrantyDetails
 
+    def warranty_async(self, parts=[]):
+        """
+        Non-blocking version of warranty()
+
+        >>> Product('DGKFL06JDHJP').warranty_async().get().warrantyStatus
+        'Out Of Warranty (No Coverage)'
+        """
+        return run_async(self.warranty, parts)
+
     def parts(self):
         """
         >>> Product('DGKFL06JDHJP').parts() # doctest: +ELLIPSIS
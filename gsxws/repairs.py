@@ -3,8 +3,12 @@
 "gsxws/repairs.py"
 import sys
 import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
-from core import GsxObject, validate
+from lxml import etree
+
+from core import GsxObject, GsxRecord, GsxError, validate, run_async, in_session
 from lookups import Lookup
 
 REPAIR_TYPES = (
@@ -23,13 +27,24 @@ REPAIR_STATUSES = (
     ('RFPU', 'Ready for Pickup')
 )
 
-class Customer(GsxObject):
+# Dispatch IDs sent in one RepairStatus request
+STATUS_CHUNK_SIZE = 50
+
+# Repairs marked complete in one MarkRepairComplete request
+COMPLETE_CHUNK_SIZE = 50
+
+class Customer(GsxRecord):
     """
     Customer address for GSX
 
     >>> Customer(adressLine1='blaa')._data
     {'adressLine1': 'blaa'}
     """
+    _fields = ('firstName', 'lastName', 'companyName', 'adressLine1',
+               'addressLine1', 'addressLine2', 'addressLine3', 'addressLine4',
+               'city', 'region', 'state', 'zipCode', 'country',
+               'primaryPhone', 'secondaryPhone', 'emailAddress',)
+
     city = ""
     region = ""
     country = ""
@@ -42,13 +57,19 @@ class Customer(GsxObject):
     primaryPhone = ""
 
 
-class RepairOrderLine(GsxObject):
+class RepairOrderLine(GsxRecord):
+    _fields = ('partNumber', 'comptiaCode', 'comptiaModifier', 'abused',
+               'returnableDamage', 'coveredByACPlus', 'diagnosedByTechId',
+               'consignmentFlag', 'replacementSerialNumber',)
+
     partNumber = ""
     comptiaCode = ""
     comptiaModifier = ""
 
 
-class ComponentCheck(GsxObject):
+class ComponentCheck(GsxRecord):
+    _fields = ('component', 'serialNumber',)
+
     component = ""
     serialNumber = ""
 
@@ -162,6 +183,10 @@ class Repair(GsxObject):
         self._status = status
         return status
 
+    def status_async(self):
+        "Non-blocking version of status()"
+        return run_async(self.status)
+
     def details(self):
         """
         The Repair Details API includes the shipment information
@@ -185,6 +210,186 @@ class Repair(GsxObject):
         return details
 
 
+def chunked(items, size):
+    """
+    Splits items into lists of at most size items
+
+    >>> chunked(range(5), 2)
+    [[0, 1], [2, 3], [4]]
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _status_chunk(numbers):
+    """
+    Returns {dispatch ID: status or GsxError} of one RepairStatus request.
+    If GSX rejects the request with a SOAP fault, the IDs are asked one
+    at a time to find out which of them failed. Any other failure (the
+    connection, a 5xx without a fault) fails the whole chunk.
+    """
+    req = GsxObject(repairConfirmationNumbers=numbers)
+    req._namespace = "asp:"
+
+    try:
+        statuses = req._submit("RepairStatusRequest", "RepairStatus", "repairStatus")
+    except GsxError, e:
+        if not e.codes or len(numbers) == 1:
+            return dict.fromkeys(numbers, e)
+        result = {}
+        for n in numbers:
+            result.update(_status_chunk([n]))
+        return result
+
+    # None if nothing was found, iterating a GsxElement yields
+    # it and its siblings, so one status is a list too
+    statuses = [] if statuses is None else list(statuses)
+    result = {}
+
+    for status in statuses:
+        result[unicode(status.repairConfirmationNumber)] = status
+
+    for n in numbers:
+        if n not in result:
+            result[n] = GsxError("No status returned for %s" % n)
+
+    return result
+
+
+def status_many(numbers, chunk_size=STATUS_CHUNK_SIZE, concurrency=8):
+    """
+    Returns the status of any number of repairs as a dict of
+    {dispatch ID: repairStatus}. The IDs are sent chunk_size at a time,
+    with up to concurrency requests running at once. IDs whose status
+    could not be fetched map to the GsxError instead.
+
+    >>> status_many(['G135773004', 'G135773005'])['G135773004'].repairStatus # doctest: +SKIP
+    u'Closed and Completed'
+    """
+    numbers = list(OrderedDict.fromkeys(unicode(n) for n in numbers))
+    result = {}
+
+    if not numbers:
+        return result
+
+    chunks = chunked(numbers, chunk_size)
+    pool = ThreadPool(min(concurrency, len(chunks)))
+
+    try:
+        for statuses in pool.imap_unordered(in_session(_status_chunk), chunks):
+            result.update(statuses)
+    finally:
+        pool.terminate()
+
+    return result
+
+
+class CompletionSummary(object):
+    "The outcome of a mark_complete_many() run"
+    def __init__(self):
+        self.completed = []
+        self.failed = {}    # dispatch ID: GsxError
+        self.unknown = {}   # dispatch ID: GsxError, may or may not be complete
+        self.attempts = 0
+
+    def __str__(self):
+        return "%d completed, %d failed, %d unknown in %d attempts" % (
+            len(self.completed), len(self.failed), len(self.unknown), self.attempts)
+
+
+def _complete_chunk(numbers):
+    """
+    Returns ({dispatch ID: None or GsxError}, {dispatch ID: GsxError})
+    of one MarkRepairComplete request. Repairs that GSX reports an error
+    for have an entry with an errorCode or errorMessage next to their
+    repairConfirmationNumber.
+    If GSX rejects the whole request with a SOAP fault, both halves are
+    tried separately, so one bad repair doesn't fail the others.
+    Any other failure (the connection, a 5xx without a fault or an answer
+    we can't read) may have happened after GSX made the changes, so the
+    outcome of those repairs is returned as unknown instead.
+    """
+    req = GsxObject(repairConfirmationNumbers=numbers)
+    req._namespace = "asp:"
+
+    try:
+        response = req._submit("MarkRepairCompleteRequest", "MarkRepairComplete",
+                               "MarkRepairCompleteResponse")
+    except GsxError, e:
+        if not e.codes:
+            return {}, dict.fromkeys(numbers, e)
+        if len(numbers) == 1:
+            return {numbers[0]: e}, {}
+        middle = len(numbers) // 2
+        result, unknown = _complete_chunk(numbers[:middle])
+        other = _complete_chunk(numbers[middle:])
+        result.update(other[0])
+        unknown.update(other[1])
+        return result, unknown
+
+    result = dict.fromkeys(numbers)
+
+    for el in response.iterchildren() if response is not None else []:
+        tag = etree.QName(el).localname
+        number = el.findtext("repairConfirmationNumber")
+
+        if tag == "operationId":
+            continue
+
+        if tag != "repairConfirmationNumbers" or number not in result:
+            e = GsxError("Unexpected MarkRepairComplete response: %s %s" % (tag, number))
+            logging.error(e)
+            return {}, dict.fromkeys(numbers, e)
+
+        code = el.findtext("errorCode")
+        message = el.findtext("errorMessage") or code
+
+        if message:
+            result[number] = GsxError(message)
+            if code:
+                result[number].codes.append(code)
+
+    return result, {}
+
+
+def mark_complete_many(numbers, chunk_size=COMPLETE_CHUNK_SIZE, concurrency=4,
+                       retries=1):
+    """
+    Marks any number of repairs complete, chunk_size at a time with up
+    to concurrency requests running at once. The repairs that GSX
+    rejected are tried again up to retries times; the ones whose outcome
+    is unknown are never sent again. Returns a CompletionSummary.
+
+    >>> print mark_complete_many(['G135773004', 'G135773005']) # doctest: +SKIP
+    2 completed, 0 failed, 0 unknown in 1 attempts
+    """
+    summary = CompletionSummary()
+    pending = list(OrderedDict.fromkeys(unicode(n) for n in numbers))
+
+    while pending and summary.attempts <= retries:
+        summary.attempts += 1
+        chunks = chunked(pending, chunk_size)
+        pool = ThreadPool(min(concurrency, len(chunks)))
+
+        try:
+            for result, unknown in pool.imap_unordered(in_session(_complete_chunk),
+                                                       chunks):
+                for number, error in result.items():
+                    if error is None:
+                        summary.completed.append(number)
+                        summary.failed.pop(number, None)
+                    else:
+                        summary.failed[number] = error
+                for number, error in unknown.items():
+                    summary.unknown[number] = error
+                    summary.failed.pop(number, None)
+        finally:
+            pool.terminate()
+
+        pending = [n for n in pending if n in summary.failed]
+
+    return summary
+
+
 class CannotDuplicateRepair(Repair):
     """
     The Create CND Repair API allows Service Providers to create a repair
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+gsxws/serializer.py
+
+Writes GsxObject payloads and SOAP envelopes straight to bytes.
+The output is identical to serializing GsxObject.to_xml()
+and the envelope with ElementTree.
+"""
+import os
+import base64
+import threading
+
+NAMESPACES = (
+    ('asp', "http://gsxws.apple.com/elements/core/asp"),
+    ('core', "http://gsxws.apple.com/elements/core"),
+    ('emea', "http://gsxws.apple.com/elements/core/asp/emea"),
+    ('glob', "http://gsxws.apple.com/elements/global"),
+    ('soapenv', "http://schemas.xmlsoap.org/soap/envelope/"),
+)
+
+ENCODING = "UTF-8"
+
+# Bytes of file data read at a time, a multiple of 3
+# so that the base64 chunks can be concatenated
+CHUNK_SIZE = 3 * 16 * 1024
+
+_envelopes = {}
+_envelopes_lock = threading.Lock()
+
+
+def escape(text, encoding=ENCODING):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text.encode(encoding, "xmlcharrefreplace")
+
+
+class FileData(object):
+    """
+    The contents of an open file, base64-encoded in chunks
+    only when the message is sent. The bytes sent are the ones
+    between where the file was positioned when it was assigned
+    and where it ended then, read again from the start on every
+    attempt, so that they always match the Content-length.
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self.name = getattr(fp, "name", None)
+        self.start = fp.tell()
+        fp.seek(0, os.SEEK_END)
+        self.size = max(fp.tell() - self.start, 0)
+        fp.seek(self.start)
+
+    @property
+    def encoded_size(self):
+        return (self.size + 2) // 3 * 4
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        "Yields the base64 encoded contents"
+        self.fp.seek(self.start)
+        left = self.size
+        rest = ""
+
+        while left:
+            data = self.fp.read(min(chunk_size, left))
+            if not data:
+                raise IOError("%s got shorter after it was attached" % self.name)
+            left -= len(data)
+            data = rest + data
+            cut = len(data) - len(data) % 3
+            rest = data[cut:]
+            if cut:
+                yield base64.b64encode(data[:cut])
+
+        if rest:
+            yield base64.b64encode(rest)
+
+    def __str__(self):
+        return "".join(self.chunks())
+
+
+class Message(object):
+    """
+    A serialized message containing FileData parts.
+    The length is known up front and iterating yields the message
+    in chunks, so file contents are never held in memory in full.
+    """
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(p.encoded_size if isinstance(p, FileData) else len(p)
+                   for p in self.parts)
+
+    def __iter__(self):
+        buf = []
+        for p in self.parts:
+            if isinstance(p, FileData):
+                if buf:
+                    yield "".join(buf)
+                    buf = []
+                for chunk in p.chunks():
+                    yield chunk
+            else:
+                buf.append(p)
+
+        if buf:
+            yield "".join(buf)
+
+    def __str__(self):
+        return "".join(self)
+
+
+def message(parts):
+    "Returns the parts as a string, or a Message if they include files"
+    if any(isinstance(p, FileData) for p in parts):
+        return Message(parts)
+    return "".join(parts)
+
+
+def is_object(value):
+    "True if value is a GsxObject"
+    return hasattr(type(value), "_items")
+
+
+def write_element(out, tag, value, encoding=ENCODING):
+    "Appends tag with value (a string or a GsxObject) to the out list"
+    tag = tag.encode(encoding)
+    out.append("<" + tag + ">")
+    start = len(out)
+
+    if isinstance(value, basestring):
+        if value:
+            out.append(escape(value, encoding))
+    elif isinstance(value, FileData):
+        # base64 needs no escaping
+        if value.size:
+            out.append(value)
+    elif is_object(value):
+        write_items(out, value._items(), encoding)
+
+    if len(out) > start:
+        out.append("</" + tag + ">")
+    else:
+        out[-1] = "<" + tag + " />"
+
+
+def write_items(out, items, encoding=ENCODING):
+    "Appends the (name, value) items of a GsxObject to the out list"
+    for k, v in items:
+        if isinstance(v, list):
+            # Repeated elements
+            for e in v:
+                if isinstance(e, basestring) or is_object(e):
+                    write_element(out, k, e, encoding)
+        else:
+            write_element(out, k, v, encoding)
+
+
+def dumps(tag, obj, encoding="utf-8"):
+    """
+    Returns obj as an XML element called tag
+
+    >>> dumps('spam', 'ham & <bacon>')
+    '<spam>ham &amp; &lt;bacon&gt;</spam>'
+    >>> dumps('spam', '')
+    '<spam />'
+    """
+    out = []
+    write_element(out, tag, obj, encoding)
+    return str(message(out))
+
+
+def envelope(namespace, method, wrapped=True):
+    """
+    Returns the (prefix, suffix) bytes of the envelope of method.
+    wrapped envelopes have a <methodRequest> container for the payload.
+    """
+    key = (namespace, method, wrapped,)
+
+    try:
+        return _envelopes[key]
+    except KeyError:
+        pass
+
+    attrs = "".join(' xmlns:%s="%s"' % ns for ns in NAMESPACES)
+    root = (namespace + method).encode(ENCODING)
+    prefix = ["<?xml version='1.0' encoding='%s'?>\n" % ENCODING,
+              "<soapenv:Envelope%s>" % attrs,
+              "<soapenv:Header /><soapenv:Body>",
+              "<%s>" % root]
+    suffix = ["</%s>" % root, "</soapenv:Body></soapenv:Envelope>"]
+
+    if wrapped:
+        prefix.append("<%sRequest>" % method)
+        suffix.insert(0, "</%sRequest>" % method)
+
+    with _envelopes_lock:
+        _envelopes[key] = ("".join(prefix), "".join(suffix),)
+
+    return _envelopes[key]
+
+
+def write_message(out, obj, method, request, session_id=None):
+    """
+    Appends the complete SOAP message to the out list.
+    request is the name of the payload element, without a session_id
+    the payload is the direct child of method (as in Authenticate).
+    """
+    wrapped = session_id is not None
+    prefix, suffix = envelope(obj._namespace, method, wrapped)
+    out.append(prefix)
+
+    if wrapped:
+        out.append("<userSession>")
+        write_element(out, "userSessionId", session_id)
+        out.append("</userSession>")
+
+    if wrapped and request == method + "Request":
+        # Some requests lack a top-level container
+        write_items(out, obj._items())
+    else:
+        write_element(out, request, obj)
+
+    out.append(suffix)
+    return out
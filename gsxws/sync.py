@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+gsxws/sync.py
+
+Keeps a local copy of the repairs matching a RepairLookup.
+Each run does one lookup and fetches the details of only the
+repairs that are new or have changed since the last run,
+which it tells about in a change feed:
+
+    >>> sync = RepairSync(RepairStore('repairs.db'), shipToCode='677592')
+    >>> for change in sync.run():  #doctest: +SKIP
+    ...     print change.kind, change.number
+
+Whether a repair has changed is told by its RepairLookup row, which
+has only a few fields (repairStatus, customerName and the like).
+A repair whose details change while its status stays the same is
+therefore not fetched again until its status does.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+from datetime import timedelta
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from lxml import etree
+
+import objectify
+import responses
+from core import GsxError, in_session
+from lookups import Lookup, REPAIR_LOOKUP_LIMIT
+from repairs import Repair
+
+# The fields of a RepairLookup row that change when the repair does
+FINGERPRINT_FIELDS = ('repairStatus',)
+
+Change = namedtuple('Change', 'seq number kind details')
+
+
+def fingerprint(row, fields=FINGERPRINT_FIELDS):
+    "Returns a digest of the fields of a lookup row"
+    values = []
+    for f in fields:
+        value = getattr(row, f, None)
+        values.append(u'' if value is None else unicode(value))
+    return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+def dump_details(details):
+    "Returns details (a GsxElement or a response model) as bytes"
+    if isinstance(details, responses.Model):
+        return 'P' + pickle.dumps(details, pickle.HIGHEST_PROTOCOL)
+    return 'X' + etree.tostring(details, encoding='utf-8')
+
+
+def load_details(data):
+    data = str(data)
+    if data[0] == 'P':
+        return pickle.loads(data[1:])
+    return etree.fromstring(data[1:], objectify.makeparser())
+
+
+class RepairStore(object):
+    """
+    The repairs and the change feed in a SQLite database,
+    which can be shared between threads and processes
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+
+        db = self._db
+        db.execute("""CREATE TABLE IF NOT EXISTS repairs (
+            number TEXT PRIMARY KEY, fingerprint TEXT, details BLOB, updated REAL)""")
+        db.execute("""CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, number TEXT, kind TEXT,
+            created REAL)""")
+
+    @property
+    def _db(self):
+        "The connection of the current thread (and process)"
+        db = getattr(self._local, 'db', None)
+
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.filename, timeout=30, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db, self._local.pid = db, os.getpid()
+
+        return db
+
+    def fingerprints(self):
+        "Returns {number: fingerprint} of the stored repairs"
+        return dict(self._db.execute("SELECT number, fingerprint FROM repairs"))
+
+    def get(self, number):
+        "Returns the stored details of repair number, or None"
+        row = self._db.execute("SELECT details FROM repairs WHERE number = ?",
+                               (number,)).fetchone()
+        return None if row is None else load_details(row[0])
+
+    def save(self, number, fingerprint, details, kind):
+        "Stores the details of a new or changed repair and returns the Change"
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT OR REPLACE INTO repairs VALUES (?, ?, ?, ?)",
+                       (number, fingerprint, sqlite3.Binary(dump_details(details)),
+                        time.time(),))
+            seq = db.execute("INSERT INTO changes (number, kind, created) "
+                             "VALUES (?, ?, ?)", (number, kind, time.time(),)).lastrowid
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return Change(seq, number, kind, details)
+
+    def remove(self, number):
+        "Deletes a repair that is gone from the lookup and returns the Change"
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM repairs WHERE number = ?", (number,))
+            seq = db.execute("INSERT INTO changes (number, kind, created) "
+                             "VALUES (?, 'removed', ?)", (number, time.time(),)).lastrowid
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return Change(seq, number, 'removed', None)
+
+    def changes(self, since=0):
+        """
+        Returns the Changes after sequence number since, oldest first,
+        with the current details of each repair
+        """
+        rows = self._db.execute("SELECT c.seq, c.number, c.kind, r.details "
+                                "FROM changes c LEFT JOIN repairs r "
+                                "ON c.number = r.number AND c.kind != 'removed' "
+                                "WHERE c.seq > ? ORDER BY c.seq", (since,))
+        return [Change(seq, number, kind, None if data is None else load_details(data))
+                for seq, number, kind, data in rows]
+
+    def prune(self, upto=None, age=None):
+        """
+        Deletes the changes up to sequence number upto, or the ones
+        older than age (a timedelta or seconds), and returns how many
+        were deleted. Sequence numbers are never reused.
+        """
+        if upto is None and age is None:
+            raise ValueError("Prune needs upto or age")
+
+        where, args = [], []
+
+        if upto is not None:
+            where.append("seq <= ?")
+            args.append(upto)
+
+        if age is not None:
+            if isinstance(age, timedelta):
+                age = age.total_seconds()
+            where.append("created < ?")
+            args.append(time.time() - age)
+
+        return self._db.execute("DELETE FROM changes WHERE " + " OR ".join(where),
+                                args).rowcount
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+        self._local = threading.local()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM repairs").fetchone()[0]
+
+
+def _fetch_details(number):
+    "Returns (number, details or the GsxError), skipping the response cache"
+    repair = Repair(number)
+    repair._fresh = True
+    try:
+        return number, repair.details()
+    except GsxError, e:
+        return number, e
+
+
+class RepairSync(object):
+    """
+    Syncs the repairs that match the lookup criteria into store.
+    Repairs whose details could not be fetched are left as they
+    were, so they're tried again on the next run. If the lookup
+    returns limit repairs, some may be missing from it, so no
+    repairs are removed on that run.
+    """
+    def __init__(self, store, concurrency=8, fields=FINGERPRINT_FIELDS,
+                 limit=REPAIR_LOOKUP_LIMIT, **criteria):
+        self.store = store
+        self.concurrency = concurrency
+        self.fields = fields
+        self.limit = limit
+        self.criteria = criteria
+        self.errors = {}
+
+    def lookup(self):
+        "Returns the current lookup rows"
+        rows = Lookup(**self.criteria).repairs()
+        return [] if rows is None else list(rows)
+
+    def run(self):
+        "Syncs once and returns the Changes it made"
+        known = self.store.fingerprints()
+        current = {}
+        changed = []
+        rows = self.lookup()
+
+        for row in rows:
+            number = unicode(row.repairConfirmationNumber)
+            current[number] = fingerprint(row, self.fields)
+            if known.get(number) != current[number]:
+                changed.append(number)
+
+        changes = []
+        self.errors = {}
+
+        if changed:
+            pool = ThreadPool(min(self.concurrency, len(changed)))
+            try:
+                for number, details in pool.imap_unordered(in_session(_fetch_details),
+                                                           changed):
+                    if isinstance(details, GsxError):
+                        logging.warning("Failed to sync repair %s: %s" % (number, details))
+                        self.errors[number] = details
+                        continue
+                    kind = 'changed' if number in known else 'new'
+                    changes.append(self.store.save(number, current[number], details, kind))
+            finally:
+                pool.terminate()
+
+        if len(rows) >= self.limit:
+            logging.warning("RepairLookup returned %d repairs, not removing any"
+                            % len(rows))
+            return changes
+
+        for number in set(known) - set(current):
+            changes.append(self.store.remove(number))
+
+        return changes
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+
+"gsxws/transport.py"
+import re
+import abc
+import json
+import time
+import errno
+import random
+import select
+import socket
+import hashlib
+import httplib
+import logging
+import threading
+from StringIO import StringIO
+
+# Connection failures that can mean the server already
+# dropped an idle keep-alive connection
+STALE_ERRORS = (socket.error, httplib.BadStatusLine,
+                httplib.CannotSendRequest, httplib.ResponseNotReady,)
+
+# Failures after the request went out that still mean a dropped
+# connection, but only calls in RETRY_SAFE may be sent again
+DROPPED_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,)
+
+# Socket errors of a connection the server has closed
+DROPPED_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED,)
+
+# Responses of an overloaded or unreachable GSX
+RETRY_STATUSES = (502, 503, 504,)
+
+# Operations that don't change anything in GSX and can be sent again
+RETRY_SAFE = re.compile(r'^(Authenticate|Fetch\w+|\w+Lookup|\w+Status|'
+                        r'\w+Details|ComponentCheck|ReturnLabel|'
+                        r'PartsPendingReturn)$')
+
+
+def is_dropped(conn):
+    """
+    True if the server has closed the idle connection conn. An idle
+    connection has nothing to read, so being readable means either
+    EOF or data nobody asked for, and both make it unusable.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def dropped(error):
+    "True if error means that the server closed the connection"
+    if isinstance(error, DROPPED_ERRORS):
+        return True
+    return isinstance(error, socket.error) and error.errno in DROPPED_ERRNOS
+
+
+class Transport(object):
+    """
+    Abstract base of the objects that can be set as core.GSX_TRANSPORT.
+    Subclasses implement request(), clear() is optional.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def request(self, host, method, path, body, headers=(), timeout=None):
+        """
+        Sends an HTTP request to host and returns the response.
+
+        body is a string, or an iterable of strings when the message
+        includes files (the Content-Length header is always given).
+        headers is a sequence of (name, value) pairs and includes
+        the SOAPAction. Errors connecting or sending are raised as is.
+
+        The response must have status, reason, getheader(name, default),
+        read(amt=None) and close(), and may have timings, a dict
+        of the seconds spent in the connect, send and wait phases.
+        """
+
+    def clear(self):
+        "Releases any resources held, like idle connections"
+        pass
+
+
+class Response(object):
+    "A response kept in memory"
+    def __init__(self, status, reason, body, headers=()):
+        self.status = status
+        self.reason = reason
+        self._body = StringIO(body)
+        self._headers = dict((k.lower(), v) for k, v in headers)
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._body.read()
+        return self._body.read(amt)
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class PooledResponse(object):
+    """
+    Wraps a httplib response and hands the connection
+    back to the pool once the body has been read.
+    """
+    def __init__(self, response, pool, host, conn, timings=None):
+        self._response = response
+        self._pool = pool
+        self._host = host
+        self._conn = conn
+        self.timings = timings or {}
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+
+        if amt is None or not data:
+            self.release()
+
+        return data
+
+    def release(self):
+        "Return the connection to the pool"
+        if self._conn is not None:
+            self._pool.put(self._host, self._conn)
+            self._conn = None
+
+    def close(self):
+        "Discard the connection without reading the rest of the body"
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ConnectionPool(Transport):
+    """
+    Keeps idle keep-alive connections around, keyed by host.
+    maxsize is the number of idle connections kept per host,
+    connections unused for more than idle_timeout seconds are closed.
+    """
+    def __init__(self, maxsize=4, idle_timeout=60,
+                 connection_class=httplib.HTTPSConnection):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connection_class = connection_class
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, timeout=None):
+        """
+        Returns (connection, reused) for host, creating
+        a new connection if there's no usable idle one
+        """
+        now = time.time()
+
+        with self._lock:
+            idle = self._idle.get(host, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout and not is_dropped(conn):
+                    # The timeout of this call, not the one it was opened with
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+
+        return self.connection_class(host, timeout=timeout), False
+
+    def put(self, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time(),))
+                return
+
+        conn.close()
+
+    def clear(self):
+        "Close all idle connections"
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle = {}
+
+    def _request(self, conn, method, path, body, headers, timings, state):
+        started = time.time()
+
+        if conn.sock is None:
+            conn.connect()
+
+        timings['connect'] = time.time() - started
+        started = time.time()
+
+        conn.putrequest(method, path)
+        for k, v in headers:
+            conn.putheader(k, v)
+        conn.endheaders()
+        state['sent'] = True
+
+        if isinstance(body, basestring):
+            conn.send(body)
+        else:
+            # Iterated again if the request has to be resent
+            for chunk in body:
+                conn.send(chunk)
+
+        state['delivered'] = True
+        timings['send'] = time.time() - started
+        started = time.time()
+        response = conn.getresponse()
+        timings['wait'] = time.time() - started
+        return response
+
+    def resend(self, error, headers, sent, delivered=True):
+        """
+        True if a request that failed with error on a reused connection
+        can be sent again on a new one. That's the case if nothing was
+        sent yet, if the server dropped the connection before it got
+        the whole body (so it can't have acted on it), or if it dropped
+        the connection without an answer to a call that changes nothing.
+        Never after a timeout, the server may still be working on the request.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if not sent:
+            return True
+        if not delivered and dropped(error):
+            return True
+        return (isinstance(error, DROPPED_ERRORS) and
+                RETRY_SAFE.match(soap_action(headers) or '') is not None)
+
+    def request(self, host, method, path, body, headers=(), timeout=None):
+        """
+        Sends the request over a pooled connection. body is a string
+        or an iterable of strings (with the length given in headers).
+        A reused connection that turns out to be broken is replaced
+        by a fresh one and the request sent again, when resend() says
+        it can't have reached GSX or is safe to repeat.
+        """
+        conn, reused = self.get(host, timeout)
+        timings, state = {}, {'sent': False, 'delivered': False}
+
+        try:
+            response = self._request(conn, method, path, body, headers, timings, state)
+        except STALE_ERRORS, e:
+            conn.close()
+            if not reused or not self.resend(e, headers, state['sent'],
+                                             state['delivered']):
+                raise
+            logging.debug("Reconnecting to %s: %r" % (host, e))
+            conn = self.connection_class(host, timeout=timeout)
+            try:
+                response = self._request(conn, method, path, body, headers, timings,
+                                         {'sent': False, 'delivered': False})
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        return PooledResponse(response, self, host, conn, timings)
+
+
+_session_id = re.compile(r'<userSessionId>[^<]*</userSessionId>')
+
+
+def soap_action(headers):
+    for k, v in headers:
+        if k.lower() == 'soapaction':
+            return v.strip('"')
+
+
+def request_key(action, body):
+    "Identifies a request regardless of the session it was made in"
+    return "%s:%s" % (action, hashlib.sha1(_session_id.sub('', body)).hexdigest(),)
+
+
+class RecordingTransport(Transport):
+    """
+    Sends requests through transport and records each
+    request/response pair, to be saved and replayed later.
+
+    >>> GSX_TRANSPORT = RecordingTransport()  #doctest: +SKIP
+    ...
+    >>> GSX_TRANSPORT.save('warranty.json')  #doctest: +SKIP
+    """
+    def __init__(self, transport=None):
+        self.transport = transport or ConnectionPool()
+        self.recordings = []
+        self._lock = threading.Lock()
+
+    def request(self, host, method, path, body, headers=(), timeout=None):
+        if not isinstance(body, basestring):
+            body = "".join(body)
+
+        res = self.transport.request(host, method, path, body, headers, timeout)
+        data = res.read()
+
+        with self._lock:
+            self.recordings.append({
+                'action': soap_action(headers),
+                'request': body.decode('utf-8'),
+                'status': res.status,
+                'reason': res.reason,
+                'response': data.decode('utf-8'),
+            })
+
+        return Response(res.status, res.reason, data)
+
+    def save(self, filename):
+        with self._lock:
+            with open(filename, 'w') as fp:
+                json.dump(self.recordings, fp, indent=1)
+
+    def clear(self):
+        self.transport.clear()
+
+
+class ReplayTransport(Transport):
+    """
+    Answers requests with recorded responses, without any network access.
+    A request is matched by its SOAP action and body (ignoring the session id).
+    Unless strict, unmatched requests get the responses recorded for the
+    same action in turn.
+    """
+    def __init__(self, recordings, strict=False):
+        if isinstance(recordings, basestring):
+            with open(recordings) as fp:
+                recordings = json.load(fp)
+
+        self.strict = strict
+        self.recordings = recordings
+        self._exact, self._actions, self._turns = {}, {}, {}
+        self._lock = threading.Lock()
+
+        for r in recordings:
+            key = request_key(r['action'], r['request'].encode('utf-8'))
+            self._exact.setdefault(key, []).append(r)
+            self._actions.setdefault(r['action'], []).append(r)
+
+    def request(self, host, method, path, body, headers=(), timeout=None):
+        if not isinstance(body, basestring):
+            body = "".join(body)
+
+        action = soap_action(headers)
+        key = request_key(action, body)
+        candidates = self._exact.get(key)
+
+        if not candidates and not self.strict:
+            key, candidates = action, self._actions.get(action)
+
+        if not candidates:
+            raise LookupError("No recorded response to %s" % action)
+
+        with self._lock:
+            turn = self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+
+        r = candidates[turn % len(candidates)]
+        return Response(r['status'], r['reason'], r['response'].encode('utf-8'))
+
+
+class RetryPolicy(object):
+    """
+    Decides how often a failed call is tried again and how long to wait.
+    Only calls matching safe are retried, after a random delay of up to
+    backoff * 2^n seconds (capped at max_backoff).
+    """
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=10, safe=RETRY_SAFE):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.safe = safe
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def retries(self, method):
+        "The number of times method may be retried"
+        if self.safe.match(method):
+            return max(self.attempts - 1, 0)
+        return 0
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def wait(self, method, attempt):
+        "Sleeps before retry number attempt (counting from 0)"
+        with self._lock:
+            self.retried += 1
+        logging.debug("Retrying %s (%d)" % (method, attempt + 1))
+        time.sleep(self.delay(attempt))
+
+    def fail(self, method):
+        "Counts a call that failed for good"
+        with self._lock:
+            self.failed += 1
+
+    @property
+    def stats(self):
+        return {'retried': self.retried, 'failed': self.failed}
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to an endpoint after threshold consecutive failures.
+    After reset_timeout seconds one call is let through, closing
+    the breaker again if it succeeds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        "True if a call may be made now"
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.OPEN and \
+                    time.time() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened = time.time()
+                self.trips += 1
+
+    @property
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'rejected': self.rejected,
+        }
+
+
+class CircuitBreakers(object):
+    "Keeps one CircuitBreaker per endpoint"
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.threshold, self.reset_timeout)
+                self._breakers[key] = breaker
+            return breaker
+
+    def clear(self):
+        with self._lock:
+            self._breakers = {}
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict((k, b.stats) for k, b in self._breakers.items())
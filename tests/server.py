@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+tests/server.py
+
+A local stand-in for GSX that answers SOAP calls with the
+fixtures in tests/fixtures, for measuring things offline:
+
+    $ python tests/server.py 8080
+
+    >>> core.GSX_URL = "http://127.0.0.1:8080/{env}/{region}"
+    >>> core.GSX_TRANSPORT = ConnectionPool(connection_class=httplib.HTTPConnection)
+"""
+import os
+import sys
+import ssl
+import json
+import threading
+import xml.etree.ElementTree as ET
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Operations answered with a recorded response
+XML_FIXTURES = {
+    'WarrantyStatus': 'warranty_status.xml',
+    'PartsLookup': 'parts_lookup.xml',
+    'RepairDetails': 'repair_details_ca.xml',
+    'FetchIOSActivationDetails': 'ios_activation.xml',
+    'OnsiteDispatchDetail': 'onsite_dispatch_detail.xml',
+    'ComptiaCodeLookup': 'comptia_lookup.xml',
+}
+
+# Operations answered by echoing the request fixture back
+# as the element the client looks for
+JSON_FIXTURES = {
+    'CreateCarryIn': ('create_carryin_repair.json', 'repairConfirmation'),
+    'UpdateCarryIn': ('update_carryin_repair.json', 'repairConfirmation'),
+    'CreateWholeUnitExchange': ('create_whole_unit_exchange.json', 'repairConfirmation'),
+    'UpdateSerialNumber': ('update_serial_number.json', 'repairConfirmation'),
+    'CreateGeneralEscalation': ('create_escalation.json', 'escalationConfirmation'),
+    'UpdateGeneralEscalation': ('update_escalation.json', 'escalationConfirmation'),
+    'CreateStockingOrder': ('create_stocking_order.json', 'orderConfirmation'),
+}
+
+ENVELOPE = """<?xml version="1.0" encoding="UTF-8"?>
+<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+<S:Body>%s</S:Body></S:Envelope>"""
+
+AUTH_RESPONSE = ENVELOPE % """<ns2:AuthenticateResponse xmlns:ns2="http://gsxws.apple.com/elements/global">
+<AuthenticateResponse><userSessionId>%s</userSessionId></AuthenticateResponse>
+</ns2:AuthenticateResponse>"""
+
+FAULT = ENVELOPE % """<S:Fault><faultcode>%s</faultcode>
+<faultstring>%s</faultstring></S:Fault>"""
+
+
+def json_to_xml(parent, tag, value):
+    "Adds value (from a JSON fixture) to parent as tag"
+    if isinstance(value, list):
+        for v in value:
+            json_to_xml(parent, tag, v)
+        return
+
+    el = ET.SubElement(parent, tag)
+
+    if isinstance(value, dict):
+        for k, v in sorted(value.items()):
+            json_to_xml(el, k, v)
+    elif value is not None:
+        el.text = unicode(value)
+
+
+class GsxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['Content-Length']))
+        method = self.headers.get('SOAPAction', '').strip('"')
+        self.server.calls.append(method)
+        self.reply(*self.answer(method, request))
+
+    def answer(self, method, request):
+        "Returns the (status, body) of the response to method"
+        if method == 'Authenticate':
+            return 200, AUTH_RESPONSE % self.server.new_session()
+        return self.server.fixture(method)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GsxServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves GSX fixtures on address (any free port by default),
+    over HTTPS if certfile (a PEM file with the key and certificate)
+    is given. Keeps track of the calls and connections it gets.
+    """
+    daemon_threads = True
+    connections = 0
+    handshakes = 0
+
+    def __init__(self, address=('127.0.0.1', 0), handler=GsxHandler,
+                 fixtures=FIXTURES_DIR, certfile=None):
+        HTTPServer.__init__(self, address, handler)
+        self.certfile = certfile
+        if certfile is not None:
+            self.socket = ssl.wrap_socket(self.socket, certfile=certfile, server_side=True,
+                                          do_handshake_on_connect=False)
+        self.fixtures = fixtures
+        self.calls = []
+        self.sessions = []
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        "The value for GSX_URL"
+        scheme = 'http' if self.certfile is None else 'https'
+        return '%s://%s:%d/{env}/{region}' % ((scheme,) + self.server_address)
+
+    def get_request(self):
+        self.connections += 1
+        sock, address = HTTPServer.get_request(self)
+        if self.certfile is not None:
+            sock.do_handshake()
+            self.handshakes += 1
+        return sock, address
+
+    def new_session(self):
+        with self._lock:
+            self.sessions.append('SESSION%d' % len(self.sessions))
+            return self.sessions[-1]
+
+    def fixture(self, method):
+        "Returns the (status, body) of the fixture response to method"
+        if method not in self._responses:
+            self._responses[method] = self._load(method)
+        return self._responses[method]
+
+    def _load(self, method):
+        if method in XML_FIXTURES:
+            with open(os.path.join(self.fixtures, XML_FIXTURES[method])) as fp:
+                return 200, fp.read()
+
+        if method in JSON_FIXTURES:
+            filename, tag = JSON_FIXTURES[method]
+            with open(os.path.join(self.fixtures, filename)) as fp:
+                data = json.load(fp)
+
+            root = ET.Element('ns1:%sResponse' % method)
+            root.set('xmlns:ns1', "http://gsxws.apple.com/elements/core/asp")
+            json_to_xml(root, tag, data)
+            return 200, ENVELOPE % ET.tostring(root, 'utf-8')
+
+        return 500, FAULT % ('SOAP.OPR.001', 'Unknown operation %s' % method)
+
+    def start(self):
+        "Serve in a background thread"
+        t = threading.Thread(target=self.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    server = GsxServer(('127.0.0.1', port))
+    print "Serving GSX fixtures at %s" % server.url
+    server.serve_forever()
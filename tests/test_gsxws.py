@@ -1,14 +1,115 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import os
+import re
+import ssl
+import time
+import errno
+import base64
+import socket
+import httplib
+import pickle
+import tempfile
+import multiprocessing
+from StringIO import StringIO
 import logging
-from datetime import date
+import threading
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, timedelta
+from functools import partial
 from os import environ as env
+from BaseHTTPServer import BaseHTTPRequestHandler
 
 from unittest import main, skip, TestCase
 
-from gsxws.objectify import parse
-from gsxws.products import Product
-from gsxws import repairs, escalations, lookups, GsxError, ServicePart
+from gsxws import objectify
+from gsxws.objectify import parse, iterparse, register_converter, gsx_text
+from gsxws.products import Product, warranty_many
+from gsxws import core, serializer, instrument, responses
+from gsxws.transport import (ConnectionPool, RetryPolicy, CircuitBreaker, CircuitBreakers,
+                             RecordingTransport, ReplayTransport)
+from tests.server import GsxServer, GsxHandler, ENVELOPE
+from gsxws.cache import GsxCache, MemoryCache, ResponseCache, private_dir
+from gsxws.catalog import Catalog
+from gsxws.comptia import CompTIA, ComptiaStore
+from gsxws import repairs, escalations, lookups, orders, GsxError, ServicePart
+
+
+SESSION_EXPIRED = """<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+<S:Body><S:Fault><faultcode>ATH.LOG.20</faultcode>
+<faultstring>Your session has expired.</faultstring></S:Fault></S:Body></S:Envelope>"""
+
+SERVER_BUSY = """<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+<S:Body><S:Fault><faultcode>S:Server</faultcode>
+<faultstring>Service Unavailable</faultstring></S:Fault></S:Body></S:Envelope>"""
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = '<ok/>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DroppingHandler(KeepAliveHandler):
+    "Counts requests, and drops or delays the answer when the test asks"
+    def setup(self):
+        self.timeout = self.server.keepalive
+        KeepAliveHandler.setup(self)
+
+    def do_POST(self):
+        self.server.posts += 1
+        if self.server.drop > 0:
+            self.server.drop -= 1
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.close_connection = 1
+            return
+        time.sleep(self.server.delay)
+        KeepAliveHandler.do_POST(self)
+
+
+class EchoHandler(KeepAliveHandler):
+    "Answers with the request body"
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FixtureHandler(GsxHandler):
+    "Answers with fixtures, or with the errors the test asks for"
+    def answer(self, method, request):
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            return 503, SERVER_BUSY
+        if any(s in request for s in self.server.expired):
+            return 500, SESSION_EXPIRED
+        if 'FAULT' in request:
+            return 500, open('tests/fixtures/multierror.xml').read()
+        time.sleep(self.server.delay)
+        return GsxHandler.answer(self, method, request)
+
+
+class LocalServer(GsxServer):
+    def __init__(self, address, handler, **kwargs):
+        GsxServer.__init__(self, address, handler, **kwargs)
+        self.expired = set()
+        self.failures = 0   # Answer this many calls with 503
+        self.posts = 0
+        self.drop = 0       # Drop the connection of this many calls
+        self.delay = 0      # Seconds to wait before answering
+        self.keepalive = None   # Seconds before closing an idle connection
 
 
 class RemoteTestCase(TestCase):
@@ -28,6 +129,926 @@ class TestCoreFunctions(TestCase):
         rep.orderLines = [part]
         self.assertRegexpMatches(rep.dumps(), '<GsxObject><blaa>ääöö</blaa><orderLines>')
 
+    def test_locale_formats(self):
+        self.assertIs(core.get_format('de_DE'), core.get_format('de_DE'))
+        self.assertEqual(core.get_format('de_DE').date(date(2013, 8, 12)), '12.08.13')
+        self.assertEqual(core.get_format('en_US').tf, '%I:%M %p')
+        self.assertEqual(core.get_format('fi_FI'), core.get_format('en_XXX'))
+
+    def test_session_locale(self):
+        session = core.GsxSession('user', 'pass', 123, 'en', 'CEST', locale='ja_JP')
+        line = core.in_session(repairs.RepairOrderLine, session)()
+        line.unitReceivedDate = date(2013, 8, 12)
+        self.assertEqual(line.unitReceivedDate, '2013/08/12')
+
+    def test_validate(self):
+        self.assertEqual(core.validate('123456789012'), 'repairNumber')
+        self.assertEqual(core.validate('DGKFL06JDHJP'), 'serialNumber')
+        self.assertTrue(core.validate('661-5097', 'partNumber'))
+        self.assertFalse(core.validate('661-5097', 'spam'))
+
+    def test_validate_many(self):
+        values = ['DGKFL06JDHJP', '013348005376007', '661-5097', 'ABC', 'blaa']
+        self.assertEqual(core.validate_many(values), [core.validate(v) for v in values])
+        self.assertRaises(ValueError, core.validate_many, [1])
+
+
+def reference_message(obj, method, request, session_id=None):
+    "Builds the SOAP message with ElementTree, as GsxRequest used to"
+    env = ET.Element("soapenv:Envelope")
+    for prefix, uri in serializer.NAMESPACES:
+        env.set("xmlns:" + prefix, uri)
+    ET.SubElement(env, "soapenv:Header")
+    root = ET.SubElement(ET.SubElement(env, "soapenv:Body"), obj._namespace + method)
+    data = obj.to_xml(request)
+
+    if session_id is None:
+        root.append(data)
+    else:
+        container = ET.SubElement(root, method + "Request")
+        user_session = ET.SubElement(container, "userSession")
+        ET.SubElement(user_session, "userSessionId").text = session_id
+        if request == method + "Request":
+            container.extend(data)
+        else:
+            container.append(data)
+
+    return ET.tostring(env, "UTF-8")
+
+
+class TestRecords(TestCase):
+    def test_slots(self):
+        line = repairs.RepairOrderLine(partNumber='661-5571', abused=True)
+        self.assertFalse(hasattr(line, '__dict__') and line.__dict__)
+        self.assertEqual(line.partNumber, '661-5571')
+        self.assertEqual(line.abused, 'Y')
+        self.assertEqual(line.comptiaCode, '')
+        self.assertEqual(line._data, {'partNumber': '661-5571', 'abused': 'Y'})
+        self.assertRaises(AttributeError, getattr, line, 'spam')
+
+    def test_dumps_keeps_size(self):
+        line = repairs.RepairOrderLine(partNumber='661-5571', abused=True)
+        line.dumps()
+        line._items()
+        # serializing must not give the record a __dict__ (or an _extra)
+        self.assertEqual([r for r in gc.get_referents(line) if isinstance(r, dict)], [])
+
+    def test_extra_fields(self):
+        line = repairs.RepairOrderLine(partNumber='661-5571', spam=1)
+        self.assertEqual(line.spam, '1')
+        self.assertEqual(line._items(), [('partNumber', '661-5571'), ('spam', '1')])
+        self.assertEqual(line.dumps(), '<GsxObject><partNumber>661-5571</partNumber>'
+                                       '<spam>1</spam></GsxObject>')
+
+    def test_defaults(self):
+        self.assertEqual(repairs.Customer().state, 'ZZ')
+        self.assertEqual(repairs.Customer(state='CA').state, 'CA')
+        self.assertNotIn('state', repairs.Customer()._data)
+
+    def test_delete(self):
+        line = repairs.RepairOrderLine(partNumber='661-5571', comptiaCode='X01')
+        del line.comptiaCode
+        self.assertEqual(line._data, {'partNumber': '661-5571'})
+
+    def test_pickle(self):
+        line = repairs.RepairOrderLine(partNumber='661-5571', spam='eggs')
+        line._namespace = 'asp:'
+        copy = pickle.loads(pickle.dumps(line))
+        self.assertEqual(copy._data, line._data)
+        self.assertEqual(copy._namespace, 'asp:')
+
+    def test_order(self):
+        order = orders.StockingOrder(purchaseOrderNumber='PO1')
+        order.add_part('661-5571', 2)
+        self.assertIn('<orderLines><partNumber>661-5571</partNumber>'
+                      '<quantity>2</quantity></orderLines>', order.dumps())
+
+    def test_setter_per_instance(self):
+        class Upload(object):
+            "Like Django's File, a file only if it wraps one"
+            def __init__(self, fp=None):
+                if fp is not None:
+                    self.name, self.fileno = fp.name, fp.fileno
+                    self.tell, self.seek, self.read = fp.tell, fp.seek, fp.read
+
+        with tempfile.NamedTemporaryFile() as fp:
+            esc = escalations.Escalation(notes=Upload())
+            self.assertIsInstance(esc.notes, Upload)
+            esc.notes = Upload(fp)
+            self.assertIsInstance(esc.notes, serializer.FileData)
+        # plain types are still resolved once
+        esc.notes = date(2013, 8, 12)
+        self.assertIn(date, core._setters)
+        self.assertNotIn(Upload, core._setters)
+
+
+class TestSerializer(TestCase):
+    def setUp(self):
+        self.repair = repairs.CarryInRepair(serialNumber='DGKFL06JDHJP',
+                                            notes=u'Ääkköset & <tags> €',
+                                            unitReceivedDate=date(2013, 8, 12),
+                                            poNumber=12345,
+                                            checkIfOutOfWarrantyCoverage=True,
+                                            empty='', missing=None)
+        self.repair.customerAddress = repairs.Customer(firstName='Sergey',
+                                                       emailAddress='a@b.c')
+        lines = []
+        for i in range(3):
+            line = repairs.RepairOrderLine(partNumber='661-%04d' % i)
+            line.comptiaCode = 'X0%d' % i
+            lines.append(line)
+        self.repair.orderLines = lines + [None]
+        self.repair._namespace = 'emea:'
+
+    def test_dumps(self):
+        self.assertEqual(self.repair.dumps(),
+                         ET.tostring(self.repair.to_xml('GsxObject'), 'utf-8'))
+
+    def test_message(self):
+        for request in ('repairData', 'CreateCarryInRequest',):
+            self.assertEqual(
+                "".join(serializer.write_message([], self.repair, 'CreateCarryIn',
+                                                 request, 'SESSION1')),
+                reference_message(self.repair, 'CreateCarryIn', request, 'SESSION1'))
+
+    def test_repeated_strings(self):
+        obj = core.GsxObject(repairConfirmationNumbers=['G1', u'G2 & <3>', ''])
+        obj._namespace = 'asp:'
+        self.assertIn('<repairConfirmationNumbers>G2 &amp; &lt;3&gt;</repairConfirmationNumbers>'
+                      '<repairConfirmationNumbers />', obj.dumps())
+        self.assertEqual(
+            "".join(serializer.write_message([], obj, 'RepairStatus',
+                                             'RepairStatusRequest', 'SESSION1')),
+            reference_message(obj, 'RepairStatus', 'RepairStatusRequest', 'SESSION1'))
+
+    def test_authenticate(self):
+        session = core.GsxSession('user', u'päss&<word>', 123, 'en', 'CEST')
+        self.assertEqual(
+            "".join(serializer.write_message([], session, 'Authenticate',
+                                             'AuthenticateRequest')),
+            reference_message(session, 'Authenticate', 'AuthenticateRequest'))
+
+    def test_empty_session(self):
+        obj = lookups.Lookup(serialNumber='DGKFL06JDHJP')
+        self.assertEqual(
+            "".join(serializer.write_message([], obj, 'PartsLookup', 'lookupRequestData', '')),
+            reference_message(obj, 'PartsLookup', 'lookupRequestData', ''))
+
+    def test_file_attachment(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(os.urandom(serializer.CHUNK_SIZE * 2 + 1))
+            fp.flush()
+            esc = escalations.Escalation(issueTypeCode='WS')
+            esc.attachment = escalations.FileAttachment(fp.name)
+            parts = serializer.write_message([], esc, 'CreateGeneralEscalation',
+                                             'escalationRequest', 'SESSION1')
+            message = serializer.message(parts)
+            expected = reference_message(esc, 'CreateGeneralEscalation',
+                                         'escalationRequest', 'SESSION1')
+
+            self.assertIsInstance(message, serializer.Message)
+            self.assertEqual(len(message), len(expected))
+            self.assertEqual(str(message), expected)
+            self.assertGreater(len(list(message)), 3)
+            # Can be sent again
+            self.assertEqual(str(message), expected)
+
+    def test_empty_file(self):
+        obj = core.GsxObject(fileData=tempfile.TemporaryFile())
+        self.assertIn('<fileData />', obj.dumps())
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.server = LocalServer(('127.0.0.1', 0), DroppingHandler).start()
+        self.host = '127.0.0.1:%d' % self.server.server_port
+        self.pool = ConnectionPool(connection_class=httplib.HTTPConnection)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, action='WarrantyStatus', timeout=None):
+        res = self.pool.request(self.host, 'POST', '/', 'spam',
+                                (('Content-length', '4'), ('SOAPAction', action),),
+                                timeout)
+        return res.read()
+
+    def test_reuse(self):
+        for i in range(5):
+            self.assertEqual(self.request(), '<ok/>')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_idle_eviction(self):
+        self.pool.idle_timeout = 0
+        self.request()
+        self.request()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_reconnect(self):
+        self.request()
+        conn, reused = self.pool.get(self.host)
+        conn.sock.shutdown(socket.SHUT_RDWR)
+        self.pool.put(self.host, conn)
+        self.assertEqual(self.request(), '<ok/>')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_dropped_safe(self):
+        self.request()
+        self.server.drop = 1
+        self.assertEqual(self.request('WarrantyStatus'), '<ok/>')
+        self.assertEqual(self.server.posts, 3)
+
+    def test_dropped_write(self):
+        self.request()
+        self.server.drop = 1
+        self.assertRaises(httplib.BadStatusLine, self.request, 'CreateCarryIn')
+        self.assertEqual(self.server.posts, 2)
+
+    def test_closed_by_server(self):
+        self.server.keepalive = 0.2
+        self.request('CreateCarryIn')
+        time.sleep(0.5)
+        # not safe to resend, so it must not go out on the closed connection
+        self.assertEqual(self.request('CreateCarryIn'), '<ok/>')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.posts, 2)
+
+    def test_resend_undelivered(self):
+        headers = (('SOAPAction', 'CreateCarryIn'),)
+        error = socket.error(errno.EPIPE, 'Broken pipe')
+        self.assertTrue(self.pool.resend(error, headers, True, False))
+        self.assertFalse(self.pool.resend(error, headers, True, True))
+        self.assertFalse(self.pool.resend(socket.timeout(), headers, True, False))
+
+    def test_timeout_not_resent(self):
+        self.request()
+        self.server.delay = 0.3
+        self.assertRaises(socket.timeout, self.request, 'WarrantyStatus', 0.1)
+        time.sleep(0.4)
+        self.assertEqual(self.server.posts, 2)
+
+
+class TestStreamingUpload(TestCase):
+    def setUp(self):
+        self.server = LocalServer(('127.0.0.1', 0), EchoHandler).start()
+        self.host = '127.0.0.1:%d' % self.server.server_port
+        self.pool = ConnectionPool(connection_class=httplib.HTTPConnection)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_upload(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(os.urandom(500 * 1024))
+            fp.flush()
+            esc = escalations.Escalation(attachment=escalations.FileAttachment(fp.name))
+            message = serializer.message(serializer.write_message(
+                [], esc, 'CreateGeneralEscalation', 'escalationRequest', 'SESSION1'))
+
+            res = self.pool.request(self.host, 'POST', '/', message,
+                                    (('Content-length', str(len(message))),))
+            self.assertEqual(res.read(), str(message))
+
+    def test_file_changes(self):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write('spam and eggs')
+            fp.flush()
+            data = serializer.FileData(open(fp.name, 'rb'))
+            sent = str(data)
+            # the file grows and the caller moves it, every attempt sends the same
+            fp.write(' and ham')
+            fp.flush()
+            data.fp.read()
+            self.assertEqual(str(data), sent)
+            self.assertEqual(base64.b64decode(sent), 'spam and eggs')
+            self.assertEqual(data.encoded_size, len(sent))
+
+    def test_file_shrinks(self):
+        fp = StringIO('spam and eggs')
+        data = serializer.FileData(fp)
+        fp.truncate(4)
+        self.assertRaises(IOError, str, data)
+
+
+class LocalTestCase(TestCase):
+    "Points the library at a local server answering with fixtures"
+    handler = FixtureHandler
+    certfile = None
+    connection_class = httplib.HTTPConnection
+
+    def setUp(self):
+        self.server = LocalServer(('127.0.0.1', 0), self.handler,
+                                  certfile=self.certfile).start()
+        self._saved = (core.GSX_URL, core.GSX_TRANSPORT, core.GSX_SESSION,
+                       core.GSX_CACHE, core.GSX_RETRY, core.GSX_BREAKERS,)
+        core.GSX_CACHE = ResponseCache()
+        core.GSX_RETRY = RetryPolicy(backoff=0)
+        core.GSX_BREAKERS = CircuitBreakers()
+        core.GSX_URL = self.server.url
+        core.GSX_TRANSPORT = ConnectionPool(connection_class=self.connection_class)
+        core.GSX_SESSION = self.connect('user')
+
+    def connect(self, user, region='emea'):
+        session = core.GsxSession(user, 'pass', 123, 'en', 'CEST', 'it', region)
+        session._cache.delete(session._cache_key)
+        return session
+
+    def tearDown(self):
+        core.GSX_TRANSPORT.clear()
+        (core.GSX_URL, core.GSX_TRANSPORT, core.GSX_SESSION,
+         core.GSX_CACHE, core.GSX_RETRY, core.GSX_BREAKERS,) = self._saved
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestHttps(LocalTestCase):
+    "The local server over TLS, with its self-signed certificate"
+    certfile = 'tests/fixtures/localhost.pem'
+    connection_class = partial(httplib.HTTPSConnection,
+                               context=ssl._create_unverified_context())
+
+    def setUp(self):
+        super(TestHttps, self).setUp()
+        core.GSX_CACHE = None
+
+    def test_one_handshake(self):
+        self.assertTrue(self.server.url.startswith('https://'))
+        for i in range(3):
+            Product('DGKFL06JDHJP').warranty()
+        # Authenticate and three warranty checks over one connection
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 3)
+        self.assertEqual(self.server.handshakes, 1)
+
+    def test_timeout_not_resent(self):
+        saved = core.GSX_TIMEOUT
+        Product('DGKFL06JDHJP').warranty()
+        self.server.delay = 0.3
+        core.GSX_TIMEOUT = 0.1
+        try:
+            repair = repairs.CarryInRepair(serialNumber='DGKFL06JDHJP')
+            self.assertRaises(GsxError, repair.create)
+        finally:
+            core.GSX_TIMEOUT = saved
+        time.sleep(0.4)
+        self.assertEqual(self.server.calls.count('CreateCarryIn'), 1)
+
+
+class TestInstrumentation(LocalTestCase):
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.calls = []
+        self.collector = instrument.Collector()
+        instrument.add_hook(self.calls.append)
+        instrument.add_hook(self.collector)
+
+    def tearDown(self):
+        instrument.remove_hook(self.calls.append)
+        instrument.remove_hook(self.collector)
+        super(TestInstrumentation, self).tearDown()
+
+    def test_phases(self):
+        Product('DGKFL06JDHJP').warranty()
+        auth, call = self.calls
+        self.assertEqual(auth.method, 'Authenticate')
+        self.assertEqual(call.method, 'WarrantyStatus')
+        self.assertEqual(call.status, 200)
+        self.assertEqual(set(call.phases), set(instrument.PHASES))
+        self.assertEqual(call.response_bytes,
+                         os.path.getsize('tests/fixtures/warranty_status.xml'))
+        self.assertGreater(call.request_bytes, 0)
+
+    def test_cached(self):
+        for i in range(2):
+            Product('DGKFL06JDHJP').warranty()
+        self.assertTrue(self.calls[-1].cached)
+        self.assertEqual(set(self.calls[-1].phases), set(['parse']))
+
+    def test_faults(self):
+        core.GSX_SESSION.login()
+        self.assertRaises(GsxError, Product('FAULT').warranty)
+        self.assertEqual(self.calls[-1].status, 500)
+        self.assertIn('RPR.ONS.025', self.calls[-1].faults)
+
+    def test_stream(self):
+        list(lookups.Lookup(serialNumber='DGKFL06JDHJP').parts(stream=True))
+        self.assertEqual(self.calls[-1].method, 'PartsLookup')
+        self.assertIn('parse', self.calls[-1].phases)
+
+    def test_stream_not_read(self):
+        core.GSX_SESSION.login()
+        parts = lookups.Lookup(serialNumber='DGKFL06JDHJP').parts(stream=True)
+        self.assertEqual(len(self.calls), 1)
+        del parts
+        gc.collect()
+        self.assertEqual(self.calls[-1].method, 'PartsLookup')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_stream_partly_read(self):
+        core.GSX_SESSION.login()
+        with lookups.Lookup(serialNumber='DGKFL06JDHJP').parts(stream=True) as parts:
+            self.assertEqual(next(parts).partNumber, '661-4448')
+        self.assertEqual(self.calls[-1].method, 'PartsLookup')
+        self.assertEqual(list(parts), [])
+        self.assertEqual(len(self.calls), 2)
+        # the connection was closed, not handed out half read
+        Product('DGKFL06JDHJP').warranty()
+        self.assertEqual(self.calls[-1].status, 200)
+
+    def test_collector(self):
+        core.GSX_SESSION.login()
+        self.server.failures = 1
+        for i in range(3):
+            Product('DGKFL06JDHJP').warranty()
+        self.assertRaises(GsxError, Product('FAULT').warranty)
+
+        stats = self.collector.snapshot()['WarrantyStatus']
+        self.assertEqual(stats['latency']['count'], 4)
+        self.assertEqual(stats['cached'], 2)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['faults']['RPR.ONS.025'], 1)
+        self.assertLessEqual(stats['latency']['p50'], stats['latency']['p99'])
+        self.assertIn('wait', stats['phases'])
+
+    def test_broken_hook(self):
+        def hook(call):
+            raise ValueError()
+        instrument.add_hook(hook)
+        try:
+            Product('DGKFL06JDHJP').warranty()
+        finally:
+            instrument.remove_hook(hook)
+
+
+class TestRetries(LocalTestCase):
+    def setUp(self):
+        super(TestRetries, self).setUp()
+        core.GSX_SESSION.login()
+
+    def test_retry_lookup(self):
+        self.server.failures = 2
+        Product('DGKFL06JDHJP').warranty()
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 3)
+        self.assertEqual(core.metrics()['retry'], {'retried': 2, 'failed': 0})
+
+    def test_give_up(self):
+        self.server.failures = 5
+        self.assertRaises(GsxError, Product('DGKFL06JDHJP').warranty)
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 3)
+        self.assertEqual(core.metrics()['retry'], {'retried': 2, 'failed': 1})
+
+    def test_no_retry_create(self):
+        self.server.failures = 1
+        self.assertRaises(GsxError, repairs.CarryInRepair(serialNumber='DGKFL06JDHJP').create)
+        self.assertEqual(self.server.calls.count('CreateCarryIn'), 1)
+
+    def test_circuit_breaker(self):
+        core.GSX_BREAKERS = CircuitBreakers(threshold=2, reset_timeout=60)
+        self.server.failures = 10
+        for i in range(3):
+            self.assertRaises(GsxError, Product('DGKFL06JDHJP').warranty)
+
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 2)
+        stats = core.metrics()['breakers']['it/emea']
+        self.assertEqual(stats['state'], 'open')
+        self.assertEqual(stats['rejected'], 3)
+
+
+class TestCircuitBreaker(TestCase):
+    def test_states(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        # Only one call gets through to try again
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.trips, 2)
+
+    def test_safe_methods(self):
+        policy = RetryPolicy(attempts=3)
+        for method in ('WarrantyStatus', 'PartsLookup', 'RepairDetails',
+                       'FetchProductModel', 'Authenticate'):
+            self.assertEqual(policy.retries(method), 2)
+        for method in ('CreateCarryIn', 'UpdateCarryIn', 'MarkRepairComplete'):
+            self.assertEqual(policy.retries(method), 0)
+
+
+class TestGsxServer(LocalTestCase):
+    def test_json_fixture(self):
+        result = repairs.CarryInRepair(serialNumber='C3TFJJTNDCP9').create()
+        self.assertEqual(result.serialNumber, 'C3TFJJTNDCP9')
+        self.assertEqual(result.orderLines.partNumber, 'FD661-6136')
+
+    def test_unknown_operation(self):
+        with self.assertRaisesRegexp(GsxError, 'Unknown operation'):
+            repairs.Repair('123456789012').mark_complete()
+
+
+class TestRecordReplay(LocalTestCase):
+    def test_abstract_transport(self):
+        from gsxws.transport import Transport
+        self.assertRaises(TypeError, Transport)
+
+    def test_replay(self):
+        core.GSX_TRANSPORT = RecordingTransport(core.GSX_TRANSPORT)
+        warranty = Product('DGKFL06JDHJP').warranty()
+        parts = Product('DGKFL06JDHJP').parts()
+
+        with tempfile.NamedTemporaryFile() as fp:
+            core.GSX_TRANSPORT.save(fp.name)
+            self.assertEqual(len(core.GSX_TRANSPORT.recordings), 3)
+            core.GSX_TRANSPORT = ReplayTransport(fp.name, strict=True)
+
+        self.server.shutdown()
+        core.GSX_CACHE.clear()
+        core.GSX_SESSION = self.connect('user')
+
+        self.assertEqual(Product('DGKFL06JDHJP').warranty().configDescription,
+                         warranty.configDescription)
+        self.assertEqual(len(Product('DGKFL06JDHJP').parts()), len(parts))
+        self.assertRaises(GsxError, Product('C3TFJJTNDCP9').warranty)
+
+
+class TestAsyncFunctions(LocalTestCase):
+    def test_warranty(self):
+        results = [Product('DGKFL06JDHJP').warranty_async() for i in range(5)]
+        for r in results:
+            self.assertEqual(r.get(5).configDescription, 'IPHONE 4,16GB BLACK')
+
+    def test_parts(self):
+        parts = lookups.Lookup(partNumber='661-5732').parts_async().get(5)
+        self.assertEqual(parts[0].partDescription, 'SVC,REMOTE')
+
+
+class TestBulkWarranty(LocalTestCase):
+    def test_warranty_many(self):
+        serials = ['DGKFL06JDHJP', 'FAULT000000', '013348005376007']
+        progress = []
+        results = dict(warranty_many(serials, 2, progress.append))
+        self.assertEqual(sorted(results.keys()), sorted(serials))
+        self.assertIsInstance(results['FAULT000000'], GsxError)
+        self.assertEqual(results['DGKFL06JDHJP'].configDescription,
+                         'IPHONE 4,16GB BLACK')
+        self.assertEqual(progress[-1].done, 3)
+        self.assertEqual(progress[-1].errors, 1)
+
+    def test_warranty_many_errors(self):
+        def fail(self):
+            raise socket.error("Connection reset")
+
+        saved = Product.warranty
+        Product.warranty = fail
+        try:
+            results = dict(warranty_many(['DGKFL06JDHJP', 'DGKFL06JDHJQ']))
+        finally:
+            Product.warranty = saved
+
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results['DGKFL06JDHJP'], socket.error)
+
+    def test_warranty_many_lazy(self):
+        read = []
+
+        def serials():
+            for i in range(100):
+                read.append(i)
+                yield 'DGKFL06JD%03d' % i
+
+        results = warranty_many(serials(), 2)
+        next(results)
+        # only enough serials to keep the pool busy
+        self.assertLessEqual(len(read), 5)
+        self.assertEqual(len(list(results)), 99)
+        self.assertEqual(len(read), 100)
+
+
+class TestResponseCache(LocalTestCase):
+    def test_cached_warranty(self):
+        Product('DGKFL06JDHJP').warranty()
+        Product('DGKFL06JDHJP').warranty()
+        Product('DGKFL06JDHJQ').warranty()
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 2)
+        self.assertEqual(core.GSX_CACHE.stats['hits'], 1)
+        self.assertEqual(core.GSX_CACHE.stats['misses'], 2)
+
+    def test_per_account(self):
+        Product('DGKFL06JDHJP').warranty()
+        core.GSX_SESSION = core.GsxSession('user', 'pass', 456, 'en', 'CEST', 'it', 'emea')
+        core.GSX_SESSION._cache.delete(core.GSX_SESSION._cache_key)
+        Product('DGKFL06JDHJP').warranty()
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 2)
+        self.assertEqual(core.GSX_CACHE.stats['hits'], 0)
+
+    def test_errors_not_cached(self):
+        for i in range(2):
+            self.assertRaises(GsxError, Product('FAULT000000').warranty)
+        self.assertEqual(self.server.calls.count('WarrantyStatus'), 2)
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(maxsize=2)
+        cache.set('a', 1, 10).set('b', 2, 10)
+        cache.get('a')
+        cache.set('c', 3, 10)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_expiry(self):
+        cache = MemoryCache()
+        cache.set('a', 1, -1)
+        self.assertIsNone(cache.get('a'))
+
+
+def fill_cache(filename, start):
+    with GsxCache('procs', filename=filename) as cache:
+        for i in range(start, start + 50):
+            cache.set(str(i), i)
+
+
+class TestGsxCache(TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.cache = GsxCache('test', maxsize=10, filename=self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        os.unlink(self.filename)
+
+    def test_get_set(self):
+        self.cache.set('spam', {'eggs': 1})
+        self.assertEqual(self.cache.get('spam'), {'eggs': 1})
+        self.assertIsNone(self.cache.get('ham'))
+
+    def test_expiry(self):
+        self.cache.set('spam', 'eggs', -1)
+        self.assertIsNone(self.cache.get('spam'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('lock', 1))
+        self.assertFalse(self.cache.add('lock', 2))
+        self.assertEqual(self.cache.get('lock'), 1)
+        self.cache.set('lock', 1, -1)
+        self.assertTrue(self.cache.add('lock', 3))
+
+    def test_eviction(self):
+        for i in range(15):
+            self.cache.set(str(i), i, 100 + i)
+        self.assertEqual(len(self.cache), 10)
+        self.assertIsNone(self.cache.get('0'))
+        self.assertEqual(self.cache.get('14'), 14)
+
+    def test_threads(self):
+        def fill(start):
+            for i in range(start, start + 5):
+                self.cache.set(str(i), i)
+        threads = [threading.Thread(target=fill, args=(i * 5,)) for i in range(2)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(len(self.cache), 10)
+
+    def test_private_dir(self):
+        name = 'gsxws_test_%d' % os.getpid()
+        path = private_dir(name)
+        try:
+            self.assertEqual(private_dir(name), path)
+            self.assertEqual(os.stat(path).st_mode & 0777, 0700)
+            # others could plant a pickle in it
+            os.chmod(path, 0777)
+            self.assertRaises(EnvironmentError, private_dir, name)
+        finally:
+            os.rmdir(path)
+
+    def test_default_filename(self):
+        with GsxCache('test') as cache:
+            self.assertEqual(os.path.dirname(cache.filename), private_dir())
+
+    def test_processes(self):
+        procs = [multiprocessing.Process(target=fill_cache,
+                                         args=(self.filename, i * 50,))
+                 for i in range(4)]
+        [p.start() for p in procs]
+        [p.join() for p in procs]
+        self.assertEqual([p.exitcode for p in procs], [0] * 4)
+        with GsxCache('procs', filename=self.filename) as cache:
+            self.assertEqual(len(cache), 200)
+
+
+class TestCatalog(TestCase):
+    YAML = """IMAC:
+    name: iMac
+    models:
+        - "iMac (27-inch, Mid 2011)"
+        - "iMac (21.5-inch, Mid 2011)"
+MACMINI:
+    name: Mac mini
+    models:
+        - "Mac mini (Mid 2011)"
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'products.yaml')
+        with open(self.path, 'w') as fp:
+            fp.write(self.YAML)
+        self.snapshot = os.path.join(self.tmpdir, 'products.pickle')
+        self.catalog = Catalog(self.path, self.snapshot)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_models(self):
+        from gsxws.products import models
+        self.assertEqual(self.catalog.models()['MACMINI'],
+                         {'name': 'Mac mini', 'models': ['Mac mini (Mid 2011)']})
+        self.assertIn('iMac (27-inch, Mid 2011)', models()['IMAC']['models'])
+        # callers get their own copy
+        self.catalog.models()['IMAC']['models'].append('spam')
+        self.assertEqual(len(self.catalog.line('IMAC')), 2)
+
+    def test_indexes(self):
+        self.assertEqual(self.catalog.product_line('Mac mini (Mid 2011)'), 'MACMINI')
+        self.assertIsNone(self.catalog.product_line('mac mini (mid 2011)'))
+        self.assertEqual(self.catalog.lines(), [('IMAC', 'iMac'), ('MACMINI', 'Mac mini')])
+        self.assertRaises(ValueError, self.catalog.line, 'SPAM')
+
+    def test_search(self):
+        self.assertEqual(self.catalog.search('IMAC ('),
+                         ['iMac (21.5-inch, Mid 2011)', 'iMac (27-inch, Mid 2011)'])
+        # prefix matches come before substring matches
+        self.assertEqual(self.catalog.search('mac'),
+                         ['Mac mini (Mid 2011)', 'iMac (21.5-inch, Mid 2011)',
+                          'iMac (27-inch, Mid 2011)'])
+        self.assertEqual(self.catalog.search('mac m'), ['Mac mini (Mid 2011)'])
+        self.assertEqual(self.catalog.search('mid 2011', limit=2),
+                         ['iMac (21.5-inch, Mid 2011)', 'iMac (27-inch, Mid 2011)'])
+        self.assertEqual(self.catalog.search('spam'), [])
+
+    def test_snapshot(self):
+        self.catalog.lines()
+        self.assertTrue(os.path.exists(self.snapshot))
+        # a new catalog reads the snapshot instead of the YAML
+        with open(self.snapshot, 'rb') as fp:
+            data = pickle.load(fp)
+        data['lines']['IMAC']['name'] = 'From snapshot'
+        with open(self.snapshot, 'wb') as fp:
+            pickle.dump(data, fp)
+        self.assertEqual(Catalog(self.path, self.snapshot).lines()[0][1], 'From snapshot')
+
+    def test_default_snapshot(self):
+        self.assertEqual(os.path.dirname(Catalog(self.path).snapshot), private_dir())
+
+    def test_reload(self):
+        self.assertEqual(self.catalog.product_line('iMac Pro'), None)
+        with open(self.path, 'a') as fp:
+            fp.write('IMACPRO:\n    name: iMac Pro\n    models:\n        - "iMac Pro"\n')
+        mtime = os.stat(self.path).st_mtime + 1
+        os.utime(self.path, (mtime, mtime))
+        self.assertEqual(self.catalog.product_line('iMac Pro'), 'IMACPRO')
+        self.assertEqual(len(Catalog(self.path, self.snapshot).lines()), 3)
+
+
+class TestComptiaStore(LocalTestCase):
+    def setUp(self):
+        super(TestComptiaStore, self).setUp()
+        fd, self.filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.cache = GsxCache('comptia', filename=self.filename)
+        self.store = ComptiaStore(cache=self.cache)
+
+    def tearDown(self):
+        self.cache.close()
+        os.unlink(self.filename)
+        super(TestComptiaStore, self).tearDown()
+
+    def lookups(self):
+        return self.server.calls.count('ComptiaCodeLookup')
+
+    def refreshed(self):
+        "Returns an Event that is set once the next background refresh is over"
+        done = threading.Event()
+        refresh = self.store._refresh
+
+        def wrapper():
+            try:
+                refresh()
+            finally:
+                done.set()
+
+        self.store._refresh = wrapper
+        return done
+
+    def test_lookups(self):
+        comptia = CompTIA(self.store)
+        self.assertEqual(comptia.fetch()['2'], {u'21A': u'Display Blank',
+                                                u'20B': u'Display Dim'})
+        self.assertEqual(comptia.symptoms('2'), ((u'20B', u'Display Dim'),
+                                                 (u'21A', u'Display Blank')))
+        self.assertEqual(sorted(comptia.symptoms()), [u'0', u'2', u'B'])
+        self.assertEqual(comptia.describe('B0A'), u'Any Camera issue')
+        self.assertIsNone(comptia.describe('spam'))
+        self.assertEqual(self.lookups(), 1)
+
+    def test_shared(self):
+        CompTIA(self.store).fetch()
+        # another process with the same database
+        other = ComptiaStore(cache=GsxCache('comptia', filename=self.filename))
+        self.assertEqual(other.get().codes, self.store.get().codes)
+        self.assertEqual(self.lookups(), 1)
+
+    def test_background_refresh(self):
+        table = self.store.get()
+        self.store.refresh = 0
+        done = self.refreshed()
+        # the stale table is returned while the new one is fetched
+        self.assertIs(self.store.get(), table)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.lookups(), 2)
+        self.assertIsNot(self.store._table, table)
+        self.assertEqual(self.store._table.codes, table.codes)
+
+    def test_refresh_again(self):
+        self.store.get()
+        self.store.refresh = 0
+
+        for i in range(3):
+            done = self.refreshed()
+            self.store._checked = 0
+            self.store.get()
+            self.assertTrue(done.wait(5))
+
+        self.assertEqual(self.lookups(), 4)
+        self.assertFalse(self.store._refreshing)
+
+    def test_refresh_lock(self):
+        self.store.get()
+        self.store.refresh = 0
+        self.assertTrue(self.cache.add(self.store.key + ':refreshing', 1))
+        done = self.refreshed()
+        self.store.get()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(self.lookups(), 1)
+
+
+class TestSessions(LocalTestCase):
+    def test_login_once(self):
+        session = core.GSX_SESSION
+        threads = [threading.Thread(target=session.login) for i in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(self.server.calls, ['Authenticate'])
+
+    def test_expired_session(self):
+        Product('DGKFL06JDHJP').warranty()
+        self.server.expired.add('SESSION0')
+        Product('DGKFL06JDHJQ').warranty()
+        self.assertEqual(self.server.calls, ['Authenticate', 'WarrantyStatus',
+                                             'WarrantyStatus', 'Authenticate',
+                                             'WarrantyStatus'])
+        self.assertEqual(core.GSX_SESSION._session_id, 'SESSION1')
+
+    def test_shared_cache(self):
+        sessions = [self.connect('user%d' % i) for i in range(3)]
+        self.assertTrue(all(s._cache is core.session_cache() for s in sessions))
+        # each account still logs in on its own
+        for s in sessions:
+            s.login()
+        self.assertEqual(len(set(s._session_id for s in sessions)), 3)
+
+    def test_proactive_refresh(self):
+        session = core.GSX_SESSION
+        session.login()
+        session._expires = datetime.now() + timedelta(seconds=30)
+        session._cache.delete(session._cache_key)
+        session.get_session()
+        self.assertEqual(session._session_id, 'SESSION1')
+
+    def test_session_per_object(self):
+        other = self.connect('other', 'apac')
+        product = Product('DGKFL06JDHJP')
+        product._gsx._session = other
+        product.warranty()
+        self.assertEqual(other._session_id, 'SESSION0')
+        self.assertFalse(core.GSX_SESSION.is_valid)
+
+    def test_pool(self):
+        pool = core.GsxSessionPool()
+        a = pool.get('user', 'pass', 123, 'it', 'emea')
+        self.assertIs(pool.get('user', 'pass', '123', 'it', 'emea'), a)
+        self.assertIsNot(pool.get('user', 'pass', 123, 'it', 'apac'), a)
+
 
 class TestErrorFunctions(TestCase):
     def setUp(self):
@@ -167,6 +1188,38 @@ class TestOnsiteCoverage(RemoteTestCase):
         self.assertFalse(self.product.is_vintage)
 
 
+class TestConverters(TestCase):
+    def setUp(self):
+        self.data = parse('tests/fixtures/warranty_status.xml',
+                          'warrantyDetailInfo')
+
+    def tearDown(self):
+        register_converter('configDescription', gsx_text)
+
+    def test_memoized(self):
+        self.assertIs(self.data.estimatedPurchaseDate,
+                      self.data.estimatedPurchaseDate)
+
+    def test_kept_by_element(self):
+        date = self.data.estimatedPurchaseDate
+        self.assertEqual(self.data.__dict__, {})
+        self.assertIs(objectify._values[self.data]['estimatedPurchaseDate'], date)
+        gc.collect()
+        count = len(objectify._values)
+        del self.data
+        gc.collect()
+        self.assertEqual(len(objectify._values), count - 1)
+
+    def test_assignment(self):
+        self.data.configDescription = 'IPHONE 5'
+        self.assertEqual(self.data.configDescription, 'IPHONE 5')
+
+    def test_register(self):
+        register_converter('configDescription', lambda v: v.lower())
+        data = parse('tests/fixtures/warranty_status.xml', 'warrantyDetailInfo')
+        self.assertEqual(data.configDescription, 'iphone 4,16gb black')
+
+
 class TestActivation(TestCase):
     def setUp(self):
         self.data = parse('tests/fixtures/ios_activation.xml',
@@ -206,6 +1259,559 @@ class TestPartsLookup(TestCase):
         self.assertEqual(self.part.partDescription, 'SVC,REMOTE')
 
 
+class TestResponseModels(TestCase):
+    fixtures = (
+        ('warranty_status.xml', responses.WarrantyDetail),
+        ('parts_lookup.xml', responses.Part),
+        ('repair_details_ca.xml', responses.RepairDetails),
+        ('ios_activation.xml', responses.ActivationDetails),
+        ('repair_confirmation.xml', responses.RepairConfirmation),
+        ('order_confirmation.xml', responses.OrderConfirmation),
+    )
+
+    def assertSameValues(self, model, element):
+        for f in model.__slots__:
+            expected, value = getattr(element, f), getattr(model, f)
+
+            if f in model._models:
+                if f in model._lists:
+                    for m, el in zip(value, expected):
+                        self.assertSameValues(m, el)
+                else:
+                    self.assertSameValues(value, expected)
+                continue
+
+            if f in model._lists:
+                value = value[0] if value else None
+
+            if isinstance(value, basestring) and isinstance(expected, (int, long)):
+                # objectify guesses numbers, models keep identifiers as they are
+                self.assertEqual(int(value), expected)
+            elif isinstance(value, float) and isinstance(expected, basestring):
+                self.assertEqual(value, objectify.gsx_price(expected))
+            else:
+                self.assertEqual(value, expected, f)
+
+    def test_fixtures(self):
+        for fixture, model in self.fixtures:
+            path = 'tests/fixtures/' + fixture
+            elements = objectify.parse(path, model._tag)
+            records = responses.parse(path, model)
+            self.assertEqual(len(records), len(elements))
+            for record, element in zip(records, elements):
+                self.assertSameValues(record, element)
+
+    def test_iterparse(self):
+        for fixture, model in self.fixtures:
+            path = 'tests/fixtures/' + fixture
+            self.assertEqual(list(responses.iterparse(path, model)),
+                             list(responses.parse(path, model)))
+
+    def test_iterparse_closes_file(self):
+        opened = []
+
+        def tracking_open(*args):
+            opened.append(open(*args))
+            return opened[-1]
+
+        fixture, model = self.fixtures[0]
+        responses.open = tracking_open
+        try:
+            records = responses.iterparse('tests/fixtures/' + fixture, model)
+            next(records)
+            records.close()
+        finally:
+            del responses.open
+        self.assertTrue(opened[0].closed)
+
+    def test_generated_fields(self):
+        for fixture, model in self.fixtures:
+            source = responses.generate('tests/fixtures/' + fixture, model._tag, 'X')
+            self.assertIn('__slots__ = %r' % (model.__slots__,), source)
+
+    def test_types(self):
+        details = responses.parse('tests/fixtures/repair_details_ca.xml',
+                                  responses.RepairDetails)
+        self.assertEqual(details.soldToCode, '0000033523')
+        self.assertIsInstance(details.dispatchSentDate, datetime)
+        self.assertIs(details.isACPlusConsumed, False)
+        self.assertEqual(details.primaryAddress.city, 'CUPERTINO')
+        self.assertEqual(len(details.partsInfo), 3)
+
+        order = responses.parse('tests/fixtures/order_confirmation.xml',
+                                responses.OrderConfirmation)[0]
+        self.assertEqual([l.quantity for l in order.orderLines], [1, 4])
+        self.assertEqual(order.totalFromOrder, 394.97)
+
+    def test_pickle(self):
+        part = responses.parse('tests/fixtures/parts_lookup.xml', responses.Part)[1]
+        self.assertEqual(pickle.loads(pickle.dumps(part)), part)
+
+
+class TestResponseModelCalls(LocalTestCase):
+    def setUp(self):
+        super(TestResponseModelCalls, self).setUp()
+        core.GSX_MODELS = True
+
+    def tearDown(self):
+        core.GSX_MODELS = False
+        super(TestResponseModelCalls, self).tearDown()
+
+    def test_warranty(self):
+        product = Product('DGKFL06JDHJP')
+        self.assertIsInstance(product.warranty()[0], responses.WarrantyDetail)
+        self.assertEqual(product.productDescription, 'iPhone 4')
+        self.assertEqual(product.warranty().daysRemaining, 0)
+
+    def test_parts(self):
+        parts = Product('DGKFL06JDHJP').parts()
+        self.assertEqual([p.partNumber for p in parts], ['661-4448', '661-4954', '661-5028'])
+        streamed = list(lookups.Lookup(serialNumber='DGKFL06JDHJP').parts(stream=True))
+        self.assertEqual(streamed, list(parts))
+
+    def test_no_model(self):
+        core.GSX_SESSION.login()
+        result = escalations.Escalation(issueTypeCode='WS').create()
+        self.assertNotIsInstance(result, responses.Model)
+        self.assertEqual(result.issueTypeCode, 'PUR')
+
+
+class TestStreamingParse(TestCase):
+    def test_iterparse(self):
+        parts = list(iterparse('tests/fixtures/parts_lookup.xml', 'parts', 128))
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[0].exchangePrice, 14.4)
+        self.assertTrue(parts[0].isSerialized)
+        self.assertEqual(parts[2].partDescription, 'SVC,STEREO HEADSET')
+
+    def test_closes_file(self):
+        opened = []
+
+        def tracking_open(*args):
+            opened.append(open(*args))
+            return opened[-1]
+
+        objectify.open = tracking_open
+        try:
+            parts = iterparse('tests/fixtures/parts_lookup.xml', 'parts')
+            next(parts)
+            parts.close()
+            list(iterparse('tests/fixtures/parts_lookup.xml', 'parts'))
+        finally:
+            del objectify.open
+        self.assertEqual([fp.closed for fp in opened], [True, True])
+
+    def test_first_record_before_end(self):
+        xml = open('tests/fixtures/parts_lookup.xml').read()
+        source = StringIO(xml[:xml.index('</parts>') + 8])
+        self.assertEqual(next(iterparse(source, 'parts')).partDescription,
+                         'SVC,REMOTE')
+
+
+class TestStreamingLookup(LocalTestCase):
+    def test_parts(self):
+        parts = lookups.Lookup(partNumber='661-5732').parts(stream=True)
+        self.assertEqual([p.partNumber for p in parts],
+                         ['661-4448', '661-4954', '661-5028'])
+        # the connection goes back to the pool once the response is read
+        lookups.Lookup(partNumber='661-5733').parts()
+        self.assertEqual(self.server.connections, 1)
+
+
+class RepairLookupHandler(FixtureHandler):
+    """
+    Answers RepairLookup with three repairs a day, capped at
+    LIMIT, and a repair that shows up in every answer
+    """
+    LIMIT = 10
+
+    def answer(self, method, request):
+        if method != 'RepairLookup' or 'FAULT' in request:
+            return FixtureHandler.answer(self, method, request)
+
+        dates = [datetime.strptime(re.search('<%s>(.*)</%s>' % (t, t), request).group(1),
+                                   '%m/%d/%y').date() for t in ('fromDate', 'toDate')]
+        numbers = ['G%s%d' % ((dates[0] + timedelta(days=d)).strftime('%y%m%d'), i)
+                   for d in range((dates[1] - dates[0]).days + 1) for i in range(3)]
+
+        if 'SINGLE' in request:
+            numbers = ['G0']
+        elif 'EMPTY' in request:
+            # Nothing after the 5th
+            numbers = [n for n in numbers if n[5:7] <= '05'][:self.LIMIT]
+        else:
+            numbers = ['G0'] + numbers[:self.LIMIT - 1]
+
+        repairs = ''.join('<lookupResponseData><repairConfirmationNumber>%s'
+                          '</repairConfirmationNumber></lookupResponseData>' % n
+                          for n in numbers)
+        return 200, ENVELOPE % ('<ns1:RepairLookupResponse xmlns:ns1='
+                                '"http://gsxws.apple.com/elements/core/asp">'
+                                '<RepairLookupResponse>%s</RepairLookupResponse>'
+                                '</ns1:RepairLookupResponse>' % repairs)
+
+
+class TestRepairsAll(LocalTestCase):
+    handler = RepairLookupHandler
+
+    def test_partitions(self):
+        lookup = lookups.Lookup(shipToCode='677592')
+        repairs = lookup.repairs_all(date(2013, 1, 1), date(2013, 1, 10),
+                                     limit=RepairLookupHandler.LIMIT)
+        numbers = [unicode(r.repairConfirmationNumber) for r in repairs]
+
+        expected = ['G0'] + ['G1301%02d%d' % (d, i) for d in range(1, 11) for i in range(3)]
+        self.assertEqual(sorted(numbers), sorted(expected))
+        self.assertEqual(len(numbers), len(set(numbers)))
+        # the whole range, its halves and the quarters that were still capped
+        self.assertGreater(self.server.calls.count('RepairLookup'), 3)
+
+    def test_single_day(self):
+        repairs = lookups.Lookup().repairs_all(date(2013, 1, 1), date(2013, 1, 1), limit=2)
+        self.assertEqual(len(list(repairs)), 4)
+        self.assertEqual(self.server.calls.count('RepairLookup'), 1)
+
+    def test_empty_range(self):
+        lookup = lookups.Lookup(serialNumber='EMPTY')
+        repairs = lookup.repairs_all(date(2013, 1, 1), date(2013, 1, 10),
+                                     limit=RepairLookupHandler.LIMIT)
+        numbers = sorted(unicode(r.repairConfirmationNumber) for r in repairs)
+        self.assertEqual(numbers, ['G1301%02d%d' % (d, i)
+                                   for d in range(1, 6) for i in range(3)])
+
+    def test_single_repair(self):
+        repairs = lookups.Lookup(serialNumber='SINGLE').repairs_all(date(2013, 1, 1),
+                                                                    date(2013, 1, 10))
+        self.assertEqual([unicode(r.repairConfirmationNumber) for r in repairs], ['G0'])
+
+    def test_error(self):
+        repairs = lookups.Lookup(serialNumber='FAULT').repairs_all(date(2013, 1, 1),
+                                                                   date(2013, 1, 2))
+        self.assertRaises(GsxError, list, repairs)
+
+
+class RepairStatusHandler(FixtureHandler):
+    "Answers RepairStatus, failing whole requests that include a BAD ID"
+    def answer(self, method, request):
+        if method != 'RepairStatus':
+            return FixtureHandler.answer(self, method, request)
+
+        numbers = re.findall('<repairConfirmationNumbers>(.*?)</', request)
+        self.server.chunks.append(numbers)
+
+        if any(n.startswith('BAD') for n in numbers):
+            return 500, open('tests/fixtures/multierror.xml').read()
+
+        if any(n.startswith('DOWN') for n in numbers):
+            return 502, ENVELOPE % ''
+
+        statuses = ''.join('<repairStatus><repairConfirmationNumber>%s'
+                           '</repairConfirmationNumber><repairStatus>Open'
+                           '</repairStatus></repairStatus>' % n
+                           for n in numbers if not n.startswith('GONE'))
+        return 200, ENVELOPE % ('<ns1:RepairStatusResponse xmlns:ns1='
+                                '"http://gsxws.apple.com/elements/core/asp">'
+                                '<RepairStatusResponse>%s</RepairStatusResponse>'
+                                '</ns1:RepairStatusResponse>' % statuses)
+
+
+class TestStatusMany(LocalTestCase):
+    handler = RepairStatusHandler
+
+    def setUp(self):
+        super(TestStatusMany, self).setUp()
+        self.server.chunks = []
+
+    def test_chunks(self):
+        numbers = ['G%03d' % i for i in range(25)]
+        result = repairs.status_many(numbers + ['G000'], chunk_size=10)
+        self.assertEqual(sorted(result), numbers)
+        self.assertEqual(result['G024'].repairStatus, 'Open')
+        self.assertEqual(sorted(len(c) for c in self.server.chunks), [5, 10, 10])
+
+    def test_errors(self):
+        result = repairs.status_many(['G1', 'BAD1', 'G2', 'GONE1'], chunk_size=10)
+        self.assertEqual(result['G1'].repairStatus, 'Open')
+        self.assertEqual(result['G2'].repairStatus, 'Open')
+        self.assertIsInstance(result['BAD1'], GsxError)
+        self.assertIsInstance(result['GONE1'], GsxError)
+        # the failed chunk is asked again one ID at a time
+        self.assertEqual(len(self.server.chunks), 5)
+
+    def test_outage(self):
+        numbers = ['G1', 'DOWN1', 'G2']
+        result = repairs.status_many(numbers, chunk_size=10)
+        self.assertEqual(sorted(result), sorted(numbers))
+        self.assertEqual(set(type(r) for r in result.values()), set([GsxError]))
+        # retried as a whole, never split into one request per ID
+        self.assertEqual(set(map(tuple, self.server.chunks)), set([tuple(numbers)]))
+
+    def test_empty(self):
+        self.assertEqual(repairs.status_many([]), {})
+
+    def test_none_found(self):
+        # no repairStatus in the response, which _submit returns as None
+        req = core.GsxObject(repairConfirmationNumbers=['GONE1'])
+        req._namespace = "asp:"
+        self.assertIsNone(req._submit("RepairStatusRequest", "RepairStatus",
+                                      "repairStatus"))
+        result = repairs.status_many(['GONE1', 'GONE2'])
+        self.assertEqual(sorted(result), ['GONE1', 'GONE2'])
+        self.assertIsInstance(result['GONE1'], GsxError)
+
+    def test_single(self):
+        result = repairs.status_many(['G1', 'GONE1'])
+        self.assertEqual(result['G1'].repairStatus, 'Open')
+        self.assertIsInstance(result['GONE1'], GsxError)
+        self.assertEqual(len(self.server.chunks), 1)
+
+
+class MarkCompleteHandler(FixtureHandler):
+    """
+    Answers MarkRepairComplete. Requests with a BAD ID fail as a whole,
+    OPEN IDs always fail on their own and FLAKY ones fail the first time.
+    """
+    def answer(self, method, request):
+        if method != 'MarkRepairComplete':
+            return FixtureHandler.answer(self, method, request)
+
+        numbers = re.findall('<repairConfirmationNumbers>(.*?)</', request)
+        self.server.chunks.append(numbers)
+
+        if any(n.startswith('BAD') for n in numbers):
+            return 500, open('tests/fixtures/multierror.xml').read()
+
+        if any(n.startswith('DOWN') for n in numbers):
+            return 502, ENVELOPE % ''
+
+        if any(n.startswith('PROXY') for n in numbers):
+            return 502, '<html><body><h1>502 Bad Gateway</h1><br></body></html>'
+
+        if any(n.startswith('G1357730') for n in numbers):
+            return 200, open('tests/fixtures/mark_repair_complete.xml').read()
+
+        if any(n.startswith('ODD') for n in numbers):
+            return 200, ENVELOPE % ('<ns1:MarkRepairCompleteResponse xmlns:ns1='
+                                    '"http://gsxws.apple.com/elements/core/asp">'
+                                    '<MarkRepairCompleteResponse><outcome>HOLD</outcome>'
+                                    '</MarkRepairCompleteResponse>'
+                                    '</ns1:MarkRepairCompleteResponse>')
+
+        failed = []
+        for n in numbers:
+            if n.startswith('OPEN') or (n.startswith('FLAKY') and n not in self.server.seen):
+                failed.append(n)
+            self.server.seen.add(n)
+
+        errors = ''.join('<repairConfirmationNumbers><repairConfirmationNumber>%s'
+                         '</repairConfirmationNumber><errorCode>RPR.COM.001</errorCode>'
+                         '<errorMessage>Repair is not ready</errorMessage>'
+                         '</repairConfirmationNumbers>' % n for n in failed)
+        return 200, ENVELOPE % ('<ns1:MarkRepairCompleteResponse xmlns:ns1='
+                                '"http://gsxws.apple.com/elements/core/asp">'
+                                '<MarkRepairCompleteResponse><operationId>1</operationId>'
+                                '%s</MarkRepairCompleteResponse>'
+                                '</ns1:MarkRepairCompleteResponse>' % errors)
+
+
+class TestMarkCompleteMany(LocalTestCase):
+    handler = MarkCompleteHandler
+
+    def setUp(self):
+        super(TestMarkCompleteMany, self).setUp()
+        self.server.chunks = []
+        self.server.seen = set()
+
+    def test_chunks(self):
+        numbers = ['G%03d' % i for i in range(12)]
+        summary = repairs.mark_complete_many(numbers, chunk_size=5)
+        self.assertEqual(sorted(summary.completed), numbers)
+        self.assertEqual(summary.failed, {})
+        self.assertEqual(summary.attempts, 1)
+        self.assertEqual(sorted(len(c) for c in self.server.chunks), [2, 5, 5])
+
+    def test_partial_failure(self):
+        numbers = ['G1', 'OPEN1', 'G2', 'FLAKY1', 'BAD1', 'G3']
+        summary = repairs.mark_complete_many(numbers, chunk_size=10, retries=2)
+        self.assertEqual(sorted(summary.completed), ['FLAKY1', 'G1', 'G2', 'G3'])
+        self.assertEqual(sorted(summary.failed), ['BAD1', 'OPEN1'])
+        self.assertEqual(summary.failed['OPEN1'].code, 'RPR.COM.001')
+        self.assertEqual(str(summary), "4 completed, 2 failed, 0 unknown in 3 attempts")
+        # only the failed repairs are sent again, split up when GSX rejects them all
+        self.assertEqual(self.server.chunks[-3:], [['OPEN1', 'BAD1'], ['OPEN1'], ['BAD1']])
+
+    def test_fixture(self):
+        summary = repairs.mark_complete_many(['G135773004', 'G135773005'], retries=0)
+        self.assertEqual(summary.completed, ['G135773004'])
+        self.assertEqual(summary.failed['G135773005'].code, 'RPR.COM.001')
+        self.assertEqual(summary.unknown, {})
+
+    def test_unknown_not_resent(self):
+        numbers = ['G1', 'DOWN1', 'G2']
+        summary = repairs.mark_complete_many(numbers, chunk_size=10, retries=2)
+        self.assertEqual(sorted(summary.unknown), sorted(numbers))
+        self.assertEqual(summary.failed, {})
+        self.assertEqual(summary.completed, [])
+        self.assertEqual(self.server.chunks, [numbers])
+
+    def test_not_xml(self):
+        summary = repairs.mark_complete_many(['G1', 'PROXY1'], retries=2)
+        self.assertEqual(sorted(summary.unknown), ['G1', 'PROXY1'])
+        self.assertEqual(summary.unknown['G1'].message, 'HTTP 502 Bad Gateway')
+        self.assertEqual(len(self.server.chunks), 1)
+
+    def test_unexpected_response(self):
+        summary = repairs.mark_complete_many(['G1', 'ODD1'], retries=2)
+        self.assertEqual(sorted(summary.unknown), ['G1', 'ODD1'])
+        self.assertIn('outcome', summary.unknown['G1'].message)
+        self.assertEqual(len(self.server.chunks), 1)
+
+
+class SyncHandler(FixtureHandler):
+    "Answers RepairLookup with the (number, status) rows of the server"
+    def answer(self, method, request):
+        if method != 'RepairLookup':
+            return FixtureHandler.answer(self, method, request)
+
+        rows = ''.join('<lookupResponseData><repairConfirmationNumber>%s'
+                       '</repairConfirmationNumber><repairStatus>%s</repairStatus>'
+                       '</lookupResponseData>' % row for row in self.server.rows)
+        return 200, ENVELOPE % ('<ns1:RepairLookupResponse xmlns:ns1='
+                                '"http://gsxws.apple.com/elements/core/asp">'
+                                '<RepairLookupResponse>%s</RepairLookupResponse>'
+                                '</ns1:RepairLookupResponse>' % rows)
+
+
+class TestRepairSync(LocalTestCase):
+    handler = SyncHandler
+
+    def setUp(self):
+        super(TestRepairSync, self).setUp()
+        from gsxws.sync import RepairStore, RepairSync
+        fd, self.filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.store = RepairStore(self.filename)
+        self.sync = RepairSync(self.store, shipToCode='677592')
+        self.server.rows = [('G%d' % i, 'Open') for i in range(20)]
+
+    def tearDown(self):
+        self.store.close()
+        os.unlink(self.filename)
+        super(TestRepairSync, self).tearDown()
+
+    def details_calls(self):
+        return self.server.calls.count('RepairDetails')
+
+    def test_sync(self):
+        changes = self.sync.run()
+        self.assertEqual(sorted(c.number for c in changes), sorted(n for n, s in self.server.rows))
+        self.assertEqual(set(c.kind for c in changes), set(['new']))
+        self.assertEqual(self.details_calls(), 20)
+        self.assertEqual(self.store.get('G3').dispatchId, 'G2093174681')
+
+        # nothing changed, so only the lookup is made
+        self.assertEqual(self.sync.run(), [])
+        self.assertEqual(self.details_calls(), 20)
+
+        self.server.rows[3] = ('G3', 'Closed')
+        self.server.rows.pop()
+        self.server.rows.append(('G99', 'Open'))
+        changes = self.sync.run()
+        self.assertEqual(sorted((c.number, c.kind) for c in changes),
+                         [('G19', 'removed'), ('G3', 'changed'), ('G99', 'new')])
+        # the changed repair was fetched from GSX, not the response cache
+        self.assertEqual(self.details_calls(), 22)
+        self.assertEqual(len(self.store), 20)
+
+    def test_feed(self):
+        self.server.rows = self.server.rows[:2]
+        first = self.sync.run()
+        self.server.rows = self.server.rows[:1]
+        self.sync.run()
+
+        feed = self.store.changes()
+        self.assertEqual([c.kind for c in feed], ['new', 'new', 'removed'])
+        self.assertEqual([c.seq for c in feed], sorted(c.seq for c in feed))
+        self.assertEqual(self.store.changes(since=max(c.seq for c in first))[0].number, 'G1')
+        details = dict((c.number, c.details) for c in feed[:2])
+        self.assertEqual(details['G0'].serialNumber, 'UV45204MS85')
+        self.assertIsNone(details['G1'])
+
+    def test_capped_lookup(self):
+        self.sync.limit = 20
+        self.sync.run()
+        # the lookup is still capped, so the missing repairs may be further down
+        self.server.rows = self.server.rows[5:] + [('G%d' % i, 'Open') for i in range(20, 25)]
+        changes = self.sync.run()
+        self.assertEqual(set(c.kind for c in changes), set(['new']))
+        self.assertEqual(len(self.store), 25)
+        # and removed once it isn't
+        self.server.rows = self.server.rows[:10]
+        changes = self.sync.run()
+        self.assertEqual(len([c for c in changes if c.kind == 'removed']), 15)
+
+    def test_prune(self):
+        self.server.rows = self.server.rows[:3]
+        changes = self.sync.run()
+        self.assertRaises(ValueError, self.store.prune)
+        self.assertEqual(self.store.prune(upto=min(c.seq for c in changes)), 1)
+        self.assertEqual(len(self.store.changes()), 2)
+        self.assertEqual(self.store.prune(age=timedelta(hours=1)), 0)
+        self.assertEqual(self.store.prune(age=-1), 2)
+        self.assertEqual(self.store.changes(), [])
+        # the repairs themselves are kept, and numbering goes on
+        self.assertEqual(len(self.store), 3)
+        self.server.rows = self.server.rows[:2]
+        self.assertGreater(self.sync.run()[0].seq, max(c.seq for c in changes))
+
+    def test_errors(self):
+        self.server.rows = [('G1', 'Open'), ('FAULT', 'Open')]
+        changes = self.sync.run()
+        self.assertEqual([c.number for c in changes], ['G1'])
+        self.assertIsInstance(self.sync.errors['FAULT'], GsxError)
+        # tried again on the next run
+        self.sync.run()
+        self.assertEqual(self.details_calls(), 3)
+
+
+class TestAttachments(TestCase):
+    def setUp(self):
+        pdf = base64.encodestring('%PDF-1.4 ' + 'x' * 100000)
+        xml = ('<Envelope><Body><ReturnLabelResponse><returnLabelData>'
+               '<returnLabelFileData>%s</returnLabelFileData>'
+               '</returnLabelData></ReturnLabelResponse></Body></Envelope>' % pdf)
+        self.data = parse(xml, 'returnLabelData')
+
+    def test_decoded_once(self):
+        label = self.data.returnLabelFileData
+        self.assertIs(self.data.returnLabelFileData, label)
+        self.assertEqual(label.size, 100009)
+        self.assertTrue(label.bytes.startswith('%PDF-1.4 xxx'))
+        self.assertEqual(os.path.getsize(label.path), label.size)
+
+    def test_bytes_closes_file(self):
+        label = self.data.returnLabelFileData
+        opened = []
+        label.open = lambda: opened.append(open(label.path, 'rb')) or opened[-1]
+        self.assertEqual(len(label.bytes), label.size)
+        self.assertTrue(opened[0].closed)
+
+    def test_cleanup(self):
+        label = self.data.returnLabelFileData
+        path = label.path
+        label.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_kept_until_exit(self):
+        path = str(self.data.returnLabelFileData)
+        del self.data
+        gc.collect()
+        # the caller still has the path
+        self.assertTrue(os.path.exists(path))
+        objectify._remove_decoded()
+        self.assertFalse(os.path.exists(path))
+
+
 class TestOnsiteDispatchDetail(TestCase):
     def setUp(self):
         self.data = parse('tests/fixtures/onsite_dispatch_detail.xml',